@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+"""
+Benchmark of the chipseq installer against a local mirror standing in for cran, Ensembl,
+sourceforge, UCSC and the other sites it downloads from.
+
+The mirror serves synthetic tool tarballs, genome FASTA, GTF and mart tables with their
+Ensembl CHECKSUMS, at the urls of chipseq_installer.py remapped with --set mirror. The
+install_tools, install_data and update_config tasks are timed in a new project directory
+with an empty download cache (cold), then in another new project directory sharing the
+cache filled by the first run (warm). Results give the wall time of each task and of each
+install step, read from the deploy trace, and are compared to a baseline: a task slower
+than its baseline time by more than the threshold is a regression.
+
+Usage:
+    python scripts/benchmark_installer.py --output results.json
+    python scripts/benchmark_installer.py --save-baseline scripts/benchmark-baseline.json
+    python scripts/benchmark_installer.py --baseline scripts/benchmark-baseline.json --threshold 0.25
+Run it with the python of the virtual environment where fabric is installed. It exits with
+status 1 when there are regressions.
+"""
+import os
+import sys
+import json
+import gzip
+import inspect
+import time
+import random
+import re
+import shutil
+import tarfile
+import zipfile
+import argparse
+import tempfile
+import threading
+import subprocess
+
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+INSTALLER_DIR = os.path.dirname(SCRIPTS_DIR)
+sys.path.insert(0, SCRIPTS_DIR)
+
+import chipseq_installer as installer
+
+# Tasks timed, in the order they are run in each project directory
+TASKS = ["install_tools", "install_data", "update_config"]
+
+CONDITIONS = ["cold", "warm"]
+
+# ================================================================================
+# == Synthetic mirror
+
+def _mirror_path(mirror_dir, url):
+    return os.path.join(mirror_dir, url.split("://", 1)[1])
+
+def _defaults(step):
+    """Return the default arguments of an install step, its urls and versions.
+    """
+    spec = getattr(inspect, "getfullargspec", getattr(inspect, "getargspec", None))(installer._unwrap(step))
+    return dict(zip(spec.args[-len(spec.defaults):], spec.defaults)) if spec.defaults else {}
+
+def _script(body):
+    return "#!/bin/sh\n# synthetic tool served by the benchmark mirror\n%s\n" % body
+
+def _write_archive(path, files):
+    """Write the archive path with files, a dictionary of name to (content, executable),
+    as a zip, tar.gz or tar.bz2 file depending on its extension.
+    """
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path, 'w') as archive:
+            for name, (content, executable) in sorted(files.items()):
+                info = zipfile.ZipInfo(name)
+                info.external_attr = (0o755 if executable else 0o644) << 16
+                archive.writestr(info, content)
+        return
+    mode = "w:bz2" if path.endswith(".bz2") else "w:gz"
+    archive = tarfile.open(path, mode)
+    try:
+        for name, (content, executable) in sorted(files.items()):
+            data = content.encode("utf-8")
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o755 if executable else 0o644
+            info.mtime = time.time()
+            archive.addfile(info, _BytesReader(data))
+    finally:
+        archive.close()
+
+class _BytesReader(object):
+    def __init__(self, data):
+        self.data, self.offset = data, 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data) - self.offset
+        block = self.data[self.offset:self.offset + size]
+        self.offset += len(block)
+        return block
+
+def _make_project(name, targets, configure=False):
+    """Return the files of a synthetic source tree name whose Makefile builds targets,
+    a dictionary of executable name to script body, and installs them in $(prefix)/bin,
+    set by its configure script when configure is set.
+    """
+    rules = ["all: %s" % " ".join(sorted(targets)), ""]
+    for target in sorted(targets):
+        rules.extend(["%s: %s.in" % (target, target), "\tcp %s.in %s" % (target, target), "\tchmod a+x %s" % target, ""])
+    rules.extend(["install: all",
+                  "\tmkdir -p $(DESTDIR)$(prefix)/bin",
+                  "\tcp %s $(DESTDIR)$(prefix)/bin" % " ".join(sorted(targets)), "",
+                  "clean:", "\trm -f %s" % " ".join(sorted(targets)), ""])
+    files = {"%s/Makefile" % name: ("CFLAGS = -O2 -m64\nprefix = /usr/local\n" + "\n".join(rules), False)}
+    for target, body in targets.items():
+        files["%s/%s.in" % (name, target)] = (_script(body), False)
+    if configure:
+        files["%s/configure" % name] = (_script(
+            'prefix=/usr/local\nfor arg in "$@"; do case $arg in --prefix=*) prefix=${arg#--prefix=};; esac; done\n'
+            'sed -i "s|^prefix = .*|prefix = $prefix|" Makefile'), True)
+    return files
+
+def build_tools(mirror_dir):
+    """Write the synthetic tools fetched by install_tools in the mirror.
+    """
+    bwa = 'prefix=$5; fasta=$6\nfor ext in amb ann bwt pac sa; do cp "$fasta" "$prefix.$ext"; done'
+    tools = {
+        installer.install_samtools: lambda name: _make_project(name, {"samtools": "exit 0"}),
+        installer.install_meme: lambda name: _make_project(name, {"meme-chip": "exit 0"}, configure=True),
+    }
+    for step, files in tools.items():
+        url = _step_url(step)
+        name = os.path.basename(url).split(".tar.")[0]
+        _write_archive(_mirror_path(mirror_dir, url), files(name))
+    version = _defaults(installer.install_bwa)["version"]
+    _write_archive(_mirror_path(mirror_dir, installer._bwa_url(version)),
+                   _make_project("bwa-%s" % version, {"bwa": bwa}))
+    # bedtools unpacks to a directory not named after its archive and builds in bin/
+    files = _make_project("bedtools-2.17.0", {"bedtools": "exit 0"})
+    files["bedtools-2.17.0/Makefile"] = (files["bedtools-2.17.0/Makefile"][0].replace(
+        "\tchmod a+x bedtools\n", "\tchmod a+x bedtools\n\tmkdir -p bin\n\tcp bedtools bin\n"), False)
+    _write_archive(_mirror_path(mirror_dir, _step_url(installer.install_bedtools)), files)
+    version = _defaults(installer.install_picard)["version"]
+    _write_archive(_mirror_path(mirror_dir, 'http://downloads.sourceforge.net/project/picard/picard-tools/%s/picard-tools-%s.zip' % (version, version)),
+                   {"picard-tools-%s/picard.jar" % version: ("synthetic", False)})
+    version = _defaults(installer.install_macs)["version"]
+    _write_archive(_mirror_path(mirror_dir, "https://github.com/downloads/taoliu/MACS/MACS-%s.tar.gz" % version),
+                   {"MACS-%s/setup.py" % version: ("# synthetic package, nothing to install\n", False),
+                    "MACS-%s/bin/macs14" % version: (_script("exit 0"), True)})
+    _write_archive(_mirror_path(mirror_dir, _step_url(installer.install_sicer)),
+                   {"SICER_V1.1/SICER/SICER.sh": (_script("exit 0"), True)})
+    ucsc_url = _defaults(installer.install_ucsc_tools)["url"]
+    for tool in installer.UCSC_TOOLS:
+        body = 'cp "$1" "$2"' if tool == "faToTwoBit" else "exit 0"
+        _write_file(_mirror_path(mirror_dir, ucsc_url + tool), _script(body))
+
+def _step_url(step):
+    return _defaults(step)["url"]
+
+def _write_file(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    mode = 'wb' if isinstance(content, bytes) else 'w'
+    with open(path, mode) as f:
+        f.write(content)
+
+def build_genomes(mirror_dir, genome_mb, seed=1):
+    """Write synthetic genome FASTA, GTF and mart tables of about genome_mb MB per genome,
+    gzipped, in the mirror, with the CHECKSUMS file of each directory.
+    """
+    rng = random.Random(seed)
+    directories = set()
+    for genome in sorted(installer.GENOMES):
+        chroms = [("%d" % (i + 1), int(genome_mb * 1024 * 1024 / 4)) for i in range(4)]
+        for url in installer.GENOMES[genome]["urls"]:
+            name = os.path.basename(url)
+            if ".dna." in name:
+                content = _fasta(chroms, rng)
+            elif name.endswith(".gtf.gz"):
+                content = _gtf(chroms, rng)
+            else:
+                content = "".join("%d\tENST%011d\tENSG%011d\n" % (i, i, i // 2) for i in range(1000))
+            path = _mirror_path(mirror_dir, url)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with gzip.open(path, 'wb') as f:
+                f.write(content.encode("ascii"))
+            directories.add(os.path.dirname(path))
+    for directory in directories:
+        lines = []
+        for name in sorted(os.listdir(directory)):
+            if name != "CHECKSUMS":
+                checksum, blocks = subprocess.check_output(["sum", "-r", os.path.join(directory, name)]).split()[:2]
+                lines.append("%s %s %s\n" % (checksum.decode("ascii"), blocks.decode("ascii"), name))
+        _write_file(os.path.join(directory, "CHECKSUMS"), "".join(lines))
+
+def _fasta(chroms, rng):
+    lines = []
+    for name, length in chroms:
+        lines.append(">%s dna:chromosome chromosome:synthetic:%s:1:%d:1\n" % (name, name, length))
+        sequence = "".join(rng.choice("ACGT") for i in range(min(length, 60 * 1000)))
+        # repeat a random block rather than drawing every base, for speed
+        sequence = (sequence * (length // len(sequence) + 1))[:length]
+        lines.extend(sequence[i:i + 60] + "\n" for i in range(0, length, 60))
+    return "".join(lines)
+
+def _gtf(chroms, rng):
+    lines = []
+    gene = 0
+    for name, length in chroms:
+        for start in range(1000, length - 20000, 20000):
+            gene += 1
+            strand = rng.choice("+-")
+            for transcript in range(2):
+                exons = [(start + i * 3000 + transcript * 100, start + i * 3000 + 1000) for i in range(3)]
+                for feature in ("exon", "CDS"):
+                    for number, (exon_start, exon_end) in enumerate(exons):
+                        lines.append('%s\tprotein_coding\t%s\t%d\t%d\t.\t%s\t.\tgene_id "ENSG%011d"; transcript_id "ENST%011d"; exon_number "%d";\n'
+                                     % (name, feature, exon_start, exon_end, strand, gene, gene * 2 + transcript, number + 1))
+    return "".join(lines)
+
+def build_jaspar(mirror_dir):
+    # configure_meme fetches the files listed in the index page of the directory
+    url = installer.JASPAR_URL
+    for i in range(200):
+        _write_file(os.path.join(_mirror_path(mirror_dir, url), "MA%04d.1.pfm" % i),
+                    "".join(" ".join(str((i + j + k) % 10) for k in range(8)) + "\n" for j in range(4)))
+    _write_file(os.path.join(_mirror_path(mirror_dir, url), "matrix_list.txt"),
+                "".join("MA%04d.1\t9.0\tTF%d\t; acc \"P%05d\"\n" % (i, i, i) for i in range(200)))
+
+def build_mirror(mirror_dir, genome_mb):
+    build_tools(mirror_dir)
+    build_genomes(mirror_dir, genome_mb)
+    build_jaspar(mirror_dir)
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(mirror_dir):
+    """Serve mirror_dir over http on a free local port in a thread, return the server.
+    Like the real sites, it answers byte range requests, used by segmented downloads.
+    """
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            relative = os.path.relpath(SimpleHTTPRequestHandler.translate_path(self, path), os.getcwd())
+            return os.path.join(mirror_dir, relative)
+
+        def end_headers(self):
+            self.send_header("Accept-Ranges", "bytes")
+            SimpleHTTPRequestHandler.end_headers(self)
+
+        def do_GET(self):
+            match = re.match(r"bytes=(\d+)-(\d+)$", self.headers.get("Range", ""))
+            path = self.translate_path(self.path)
+            if not match or not os.path.isfile(path):
+                return SimpleHTTPRequestHandler.do_GET(self)
+            start, end = int(match.group(1)), int(match.group(2))
+            size = os.path.getsize(path)
+            end = min(end, size - 1)
+            self.send_response(206)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            with open(path, 'rb') as f:
+                f.seek(start)
+                self.wfile.write(f.read(end - start + 1))
+
+        def log_message(self, *args):
+            pass
+    server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+# ================================================================================
+# == Benchmark
+
+CONFIG_SECTIONS = ["Executables", "Workflow", "Libraries", "meme parameters", "Genomes", "Gene Positions",
+                   "GeneSets", "Excluded Regions", "ExcludedRegions", "Chromosome Lengths", "Sequence Dictionary"]
+
+def new_project(project_dir):
+    """Create a project directory with this installer and a pipeline config to update.
+    """
+    for path in ("bin", "tmp", "chipseq-pipeline-master/Process10/Config"):
+        os.makedirs(os.path.join(project_dir, path))
+    os.symlink(INSTALLER_DIR, os.path.join(project_dir, "chipseq-installer-master"))
+    # the python running the benchmark stands for the virtual environment of the project
+    _write_file(os.path.join(project_dir, "bin", "activate"), "")
+    _write_file(os.path.join(project_dir, "chipseq-pipeline-master/Process10/Config/config.ini"),
+                "".join("[%s]\n\n" % section for section in CONFIG_SECTIONS))
+
+def run_task(project_dir, task, settings, log, target="local"):
+    """Run an installer task in project_dir with fab and return its wall time.
+    target is the environment task, local or local_csh.
+    """
+    command = ["fab", "-f", os.path.join(SCRIPTS_DIR, "chipseq_installer.py"),
+               "--set", ",".join("%s=%s" % item for item in sorted(settings.items())), target, task]
+    environment = dict(os.environ, PWD=project_dir)
+    start = time.time()
+    returncode = subprocess.call(command, cwd=project_dir, env=environment, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.time() - start
+    if returncode != 0:
+        raise RuntimeError("%s failed in %s, see %s" % (task, project_dir, log.name))
+    return wall
+
+def check_csh_probe(work_dir, settings):
+    """Run probe_environment under local_csh in a new project directory and raise RuntimeError
+    when it finds no python library, i.e. when a probe command does not run in csh.
+    Skipped when csh is not installed.
+    """
+    if not os.path.exists("/bin/csh"):
+        print("/bin/csh not found, probe_environment under local_csh not checked")
+        return
+    project_dir = os.path.join(work_dir, "csh")
+    new_project(project_dir)
+    _write_file(os.path.join(project_dir, "bin", "activate.csh"), "")
+    with open(os.path.join(work_dir, "csh.log"), 'w') as log:
+        for task in ("setup_environment", "probe_environment"):
+            run_task(project_dir, task, settings, log, target="local_csh")
+    with open(os.path.join(project_dir, "installed.json")) as f:
+        if not json.load(f).get("python"):
+            raise RuntimeError("probe_environment under local_csh found no python library, see %s" % log.name)
+    print("csh   probe_environment    ok")
+
+def step_times(project_dir):
+    """Return the wall time of each install step run in project_dir from its deploy trace.
+    """
+    times = {}
+    trace_file = os.path.join(project_dir, "logs", "trace.jsonl")
+    if os.path.exists(trace_file):
+        with open(trace_file) as f:
+            for line in f:
+                event = json.loads(line)
+                if event["kind"] == "step" and not event.get("skipped"):
+                    times[event["name"]] = round(event["wall"], 3)
+    return times
+
+def benchmark(work_dir, genome_mb, repeat, extra_settings=None):
+    """Run the benchmark repeat times and return the results with the median time of each task.
+    extra_settings are passed to the installer with the mirror and cache settings.
+    """
+    mirror_dir = os.path.join(work_dir, "mirror")
+    print("Building synthetic mirror in %s" % mirror_dir)
+    build_mirror(mirror_dir, genome_mb)
+    server = serve(mirror_dir)
+    mirror_url = "http://127.0.0.1:%d" % server.server_address[1]
+    runs = dict((condition, dict((task, []) for task in TASKS)) for condition in CONDITIONS)
+    steps = dict((condition, {}) for condition in CONDITIONS)
+    try:
+        for iteration in range(repeat):
+            cache_dir = os.path.join(work_dir, "cache-%d" % iteration)
+            settings = dict(extra_settings or {}, mirror=mirror_url, cache_dir=cache_dir)
+            for condition in CONDITIONS:
+                project_dir = os.path.join(work_dir, "%s-%d" % (condition, iteration))
+                new_project(project_dir)
+                with open(os.path.join(work_dir, "%s-%d.log" % (condition, iteration)), 'w') as log:
+                    run_task(project_dir, "setup_environment", settings, log)
+                    for task in TASKS:
+                        wall = run_task(project_dir, task, settings, log)
+                        runs[condition][task].append(wall)
+                        print("%-5s %-16s %8.2fs" % (condition, task, wall))
+                steps[condition] = step_times(project_dir)
+        check_csh_probe(work_dir, settings)
+    finally:
+        server.shutdown()
+    return {"genome_mb": genome_mb,
+            "repeat": repeat,
+            "host": os.uname()[1],
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "tasks": dict((condition, dict((task, round(_median(times), 3)) for task, times in tasks.items()))
+                          for condition, tasks in runs.items()),
+            "steps": steps}
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+def compare(results, baseline, threshold, min_seconds):
+    """Return the tasks slower than in baseline by more than threshold, a fraction of the
+    baseline time, and by more than min_seconds, as a list of messages.
+    """
+    regressions = []
+    for condition in CONDITIONS:
+        for task in TASKS:
+            base = baseline["tasks"].get(condition, {}).get(task)
+            current = results["tasks"][condition][task]
+            if base is None:
+                continue
+            change = (current - base) / base if base else 0
+            print("%-5s %-16s %8.2fs  baseline %8.2fs  %+6.1f%%" % (condition, task, current, base, 100 * change))
+            if current - base > max(threshold * base, min_seconds):
+                regressions.append("%s %s took %.2fs, %.1f%% more than the baseline %.2fs"
+                                   % (condition, task, current, 100 * change, base))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results to this JSON results file")
+    parser.add_argument("--save-baseline", help="write the results as the new baseline to this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="fraction of the baseline time a task may take in addition (default 0.2)")
+    parser.add_argument("--min-seconds", type=float, default=1.0,
+                        help="smallest slow down reported as a regression, in seconds (default 1)")
+    parser.add_argument("--genome-mb", type=float, default=4,
+                        help="size of each synthetic genome in MB (default 4)")
+    parser.add_argument("--repeat", type=int, default=1, help="number of runs, the median is kept (default 1)")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="installer setting, e.g. --set download_jobs=2 to decompress 2 genome files at a time")
+    parser.add_argument("--work-dir", help="directory for the mirror and project directories, kept when given")
+    args = parser.parse_args(argv[1:])
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="chipseq-benchmark-")
+    try:
+        extra_settings = dict(setting.split("=", 1) for setting in args.set)
+        results = benchmark(os.path.abspath(work_dir), args.genome_mb, args.repeat, extra_settings)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold, args.min_seconds)
+        if regressions:
+            sys.stderr.write("Regressions:\n%s\n" % "\n".join(regressions))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Compress a stream to BGZF, the blocked gzip format of samtools and tabix, and write its .gzi
+index. The file reads as any gzip file, and samtools faidx and the other htslib tools seek in
+it to a region without decompressing it from the start.
+
+Blocks of at most 64 KB are compressed by a pool of threads, zlib releasing the GIL while
+it compresses.
+
+Usage:
+    gzip -dc genome.fa.gz | bgzf.py [-@ threads] genome.fa.gz genome.fa.gz.gzi
+"""
+import sys
+import zlib
+import struct
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# uncompressed size of a block, small enough for the compressed block to fit in 64 KB, as bgzip
+BLOCK_SIZE = 0xff00
+
+EOF_BLOCK = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def compress_block(data, level=6):
+    """Return the BGZF block of data, at most BLOCK_SIZE bytes.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    if len(deflated) > 0x10000 - 26:
+        # incompressible data, stored as is
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+    # gzip header with the BC extra field giving the block size minus 1
+    header = struct.pack("<BBBBIBBHBBHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2,
+                         len(deflated) + 25)
+    return header + deflated + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def compress(source, path, index_path=None, threads=None, level=6):
+    """Write the content of the file object source to path in BGZF, and the offsets of
+    its blocks to index_path in the .gzi format of bgzip -i.
+    """
+    threads = threads or multiprocessing.cpu_count()
+    pool = ThreadPool(threads)
+    offsets = [] # compressed, uncompressed offset of each block after the first
+    compressed = uncompressed = 0
+    try:
+        with open(path, 'wb') as out:
+            while True:
+                blocks = []
+                for i in range(threads * 4):
+                    data = _read_full(source, BLOCK_SIZE)
+                    if not data:
+                        break
+                    blocks.append(data)
+                if not blocks:
+                    break
+                for data, block in zip(blocks, pool.map(lambda data: compress_block(data, level), blocks)):
+                    out.write(block)
+                    compressed += len(block)
+                    uncompressed += len(data)
+                    offsets.append((compressed, uncompressed))
+            out.write(EOF_BLOCK)
+    finally:
+        pool.close()
+        pool.join()
+    if index_path:
+        with open(index_path, 'wb') as index:
+            index.write(struct.pack("<Q", len(offsets)))
+            for offset in offsets:
+                index.write(struct.pack("<QQ", *offset))
+
+
+def _read_full(source, size):
+    """Read size bytes from source, less only at its end, as pipes return partial reads.
+    """
+    data = source.read(size)
+    while data and len(data) < size:
+        more = source.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def main(argv):
+    threads = None
+    if len(argv) > 2 and argv[1] == "-@":
+        threads = int(argv[2])
+        argv = argv[:1] + argv[3:]
+    if len(argv) not in (2, 3):
+        sys.stderr.write(__doc__)
+        return 1
+    source = getattr(sys.stdin, "buffer", sys.stdin)
+    compress(source, argv[1], argv[2] if len(argv) == 3 else None, threads)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
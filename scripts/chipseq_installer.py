@@ -17,18 +17,63 @@ Usage:
     fab -f scripts/chipseq_installer.py local deploy > chipseq_installer.out
 """
 import os
+import re
+import csv
+import sys
+import time
+import random
+import json
+import shlex
+import shutil
+import errno
+import fcntl
+import ftplib
+import glob
+import hashlib
+import inspect
+import platform
+import resource
+import functools
+import threading
+import traceback
+import zipfile
+import subprocess
+import multiprocessing
+import multiprocessing.pool
 from contextlib import contextmanager
+# modules rather than their functions and classes, which fabric would list as tasks
+try:
+    import urllib2 as urllib_request
+    import urlparse as urllib_parse
+    import httplib as http_client
+except ImportError:
+    import urllib.request as urllib_request
+    import urllib.parse as urllib_parse
+    import http.client as http_client
 
 from fabric.api import *
 from fabric.contrib.files import *
-from fabric.operations import local as lrun
+from fabric.operations import local as _local
 
 import yaml
 
+import bgzf
+import fasta_index
+import gtf2bed
+import jaspar2meme
+
 # -- Common setup
+# Settings given with --set are in env before this file is imported, so the ones users may
+# override are only given their default here with env.setdefault.
 env.hosts = ['localhost']
 env.project_dir = os.getenv('PWD')
-env.tmp_dir = os.path.join(env.project_dir, 'tmp')
+# builds unpack and compile in tmp_dir, set CHIPSEQ_BUILD_DIR to build on node-local scratch or
+# tmpfs instead of the project file system, e.g. CHIPSEQ_BUILD_DIR=/scratch/$USER
+if os.getenv('CHIPSEQ_BUILD_DIR'):
+    env.setdefault('tmp_dir', os.path.join(os.getenv('CHIPSEQ_BUILD_DIR'),
+                                           "chipseq-%s" % hashlib.sha256(env.project_dir.encode("utf-8")).hexdigest()[:12]))
+else:
+    env.setdefault('tmp_dir', os.path.join(env.project_dir, 'tmp'))
 env.bin_dir = os.path.join(env.project_dir, 'bin')
 env.lib_dir = os.path.join(env.project_dir, 'lib')
 env.annotation_dir = os.path.join(env.project_dir, 'annotation')
@@ -45,7 +90,54 @@ env.chipseq_installer = os.path.join(env.project_dir, 'chipseq-installer-master'
 env.chipseq_pipeline = os.path.join(env.project_dir, 'chipseq-pipeline-master')
 env.chipseq_path = os.path.join(env.chipseq_pipeline, 'Process10')
 env.chipseq_config_path = os.path.join(env.chipseq_path, 'Config')
+env.log_dir = os.path.join(env.project_dir, 'logs')
+env.stamp_dir = os.path.join(env.project_dir, 'stamps')
 env.use_sudo = False
+# number of install steps run at the same time by deploy_parallel, override with --set jobs=N
+env.setdefault('jobs', multiprocessing.cpu_count())
+# number of parallel make jobs used by each compile step, override with --set make_jobs=N
+env.setdefault('make_jobs', multiprocessing.cpu_count())
+# download cache shared between installs, e.g. --set cache_dir=/lustre/[me]/chipseq-cache
+env.setdefault('cache_dir', os.getenv('CHIPSEQ_CACHE_DIR', os.path.join(env.project_dir, 'cache')))
+# size limit in GB of the downloads in the cache, least recently used first removed; the
+# artifacts, indexes, motifs, wheelhouse and ccache directories of the cache are not counted
+env.setdefault('cache_size', 50)
+# number of genome and annotation files downloaded at the same time
+env.setdefault('download_jobs', 4)
+# genomes installed by install_data, e.g. --set genomes=mm9 on sites only running mouse
+env.setdefault('genomes', "grch37;mm9")
+# store genomes and annotation files block gzipped (BGZF) with .gzi indexes, --set bgzip=True
+env.setdefault('bgzip', False)
+# number of times a genome or annotation file not matching its checksum is downloaded
+env.setdefault('download_retries', 3)
+# number of connections used to download a large file in segments, and by host,
+# e.g. --set download_connections=4,host_connections="ftp.ensembl.org:8;ftp.sra.ebi.ac.uk:2"
+env.setdefault('download_connections', 4)
+env.setdefault('host_connections', "")
+# size in MB from which a file is downloaded in segments
+env.setdefault('segment_size', 64)
+# install compiled steps from the build artifact cache in cache_dir, --set artifacts=False to build them
+env.setdefault('artifacts', True)
+# install compiled steps side by side in versions/, each version in its own directory linked into
+# the project directory, and switch to a new set of versions in one rename, --set versioned=False
+# to install them in the project directory
+env.setdefault('versioned', True)
+# arguments of install steps replacing their defaults, to upgrade a tool without editing this file,
+# e.g. --set step_args="install_bwa:version=0.7.17;install_samtools:url=http://.../samtools-0.1.19.tar.bz2"
+env.setdefault('step_args', "")
+# compile through ccache when it is in the PATH, its cache shared between installs in ccache_dir,
+# env.cache_dir/ccache by default
+env.setdefault('ccache', True)
+env.setdefault('ccache_dir', None)
+# compile flags of bwa, samtools and bedtools, see BUILD_PROFILES, e.g. --set build_profile=native
+# or CHIPSEQ_BUILD_PROFILE=native in the environment of the hosts to tune the tools for
+env.setdefault('build_profile', os.getenv('CHIPSEQ_BUILD_PROFILE', 'default'))
+# number of target hosts copied to at the same time by rollout
+env.setdefault('rollout_jobs', 8)
+# install python libraries from wheels built once in cache_dir/wheelhouse, --set wheels=False to use pip install
+env.setdefault('wheels', True)
+# base url of a mirror serving http://host/path as <mirror>/host/path, e.g. --set mirror=http://mirror.local/chipseq
+env.setdefault('mirror', None)
 
 # ================================================================================
 # == Host specific setup
@@ -66,9 +158,162 @@ def local_csh():
     env.env_setup = ('env_csh.sh')
     env.activate = 'activate.csh'
 
+# ================================================================================
+# == Deploy trace
+#
+# Install steps, deploy tasks and every command they run append an event to
+# logs/trace.jsonl with their wall time, CPU time, bytes downloaded and bytes written to
+# disk, and running_max_rss_kb, the largest resident memory of the installer or of a command
+# it ran so far: the kernel only keeps the maximum over the whole process, and the commands
+# are waited for by fabric, so it is a running maximum over the steps of deploy rather than
+# the memory of the event, while deploy_parallel runs each step in a new process. At the end
+# of a deploy, the events of the run are written to logs/trace-<run>.json, to open in
+# chrome://tracing, and a summary of the steps is printed with their critical path: the
+# chain of required steps taking the longest, that bounds the time of deploy_parallel.
+
+# id of this run, shared by the processes of deploy_parallel
+_trace_run = "%s-%d" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+_trace_lock = threading.Lock()
+# bytes downloaded by this process, counted by _download
+_trace_downloaded = [0]
+
+def _traced(kind, summary=False):
+    """Decorator recording the calls of a task in the deploy trace, and printing the
+    summary of the run when it returns if summary is set.
+    """
+    def argcatcher(func):
+        @functools.wraps(func)
+        def decorator(*args, **kwargs):
+            try:
+                with _trace(kind, func.__name__), _deferred_version_switch():
+                    return func(*args, **kwargs)
+            finally:
+                if summary:
+                    _trace_summary()
+        decorator.__wrapped__ = func
+        return decorator
+    return argcatcher
+
+def _traced_command(func):
+    @functools.wraps(func)
+    def decorator(command, *args, **kwargs):
+        with _trace("command", command):
+            return func(command, *args, **kwargs)
+    return decorator
+
+# fabric local, recording every command in the deploy trace
+lrun = _traced_command(_local)
+
+@contextmanager
+def _trace(kind, name):
+    """Record the block in the deploy trace as an event of kind (run, task, step or
+    command) named name. The event is given to the block to add fields to it.
+    """
+    event = {"run": _trace_run, "kind": kind, "name": name, "start": time.time(),
+             "pid": os.getpid(), "tid": threading.current_thread().ident}
+    start_cpu, start_written, start_downloaded = _trace_counters()
+    try:
+        yield event
+    except (Exception, SystemExit, KeyboardInterrupt):
+        event["failed"] = True
+        raise
+    finally:
+        end_cpu, end_written, end_downloaded = _trace_counters()
+        usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        event.update(wall=time.time() - event["start"],
+                     cpu=end_cpu - start_cpu,
+                     running_max_rss_kb=max(u.ru_maxrss for u in usage),
+                     downloaded=end_downloaded - start_downloaded,
+                     written=end_written - start_written if start_written is not None else None)
+        _write_trace(event)
+
+def _trace_counters():
+    """Return the CPU time used by this process and the commands it ran, the bytes written
+    to disk by both, None when unknown, and the bytes downloaded.
+    """
+    cpu = sum(u.ru_utime + u.ru_stime for u in [resource.getrusage(resource.RUSAGE_SELF),
+                                                resource.getrusage(resource.RUSAGE_CHILDREN)])
+    written = None
+    try:
+        # counts the commands run by this process once they have finished
+        with open("/proc/self/io") as f:
+            written = int(dict(line.split(": ") for line in f.read().splitlines())["write_bytes"])
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    return cpu, written, _trace_downloaded[0]
+
+def _write_trace(event):
+    try:
+        # not _make_dir, its command would be traced
+        os.makedirs(env.log_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    line = json.dumps(event, sort_keys=True) + "\n"
+    with _trace_lock:
+        # lines appended in one write do not mix between the processes of deploy_parallel
+        with open(os.path.join(env.log_dir, "trace.jsonl"), 'a') as f:
+            f.write(line)
+
+def _trace_events(run=None):
+    """Return the events of run, this run by default, read from logs/trace.jsonl.
+    """
+    trace_file = os.path.join(env.log_dir, "trace.jsonl")
+    if not lexists(trace_file):
+        return []
+    with open(trace_file) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    return [event for event in events if event["run"] == (run or _trace_run)]
+
+def _trace_summary():
+    """Write the Chrome trace of this run and print the summary of its steps.
+    """
+    events = _trace_events()
+    if not events:
+        return
+    chrome_file = os.path.join(env.log_dir, "trace-%s.json" % _trace_run)
+    with open(chrome_file, 'w') as f:
+        json.dump({"traceEvents": [{"name": event["name"][:200], "cat": event["kind"], "ph": "X",
+                                    "ts": int(event["start"] * 1e6), "dur": int(event["wall"] * 1e6),
+                                    "pid": event["pid"], "tid": event["tid"],
+                                    "args": dict((k, event.get(k)) for k in ("cpu", "running_max_rss_kb", "downloaded", "written", "failed", "skipped"))}
+                                   for event in events]}, f)
+    steps = [event for event in events if event["kind"] == "step"]
+    critical = _critical_path(dict((event["name"], event["wall"]) for event in steps))
+    puts("Deploy trace of run %s (%s, chrome://tracing: %s)" % (_trace_run, os.path.join(env.log_dir, "trace.jsonl"), chrome_file))
+    puts("  %-28s %10s %10s %10s %12s %12s" % ("step (* critical path)", "wall s", "cpu s", "run max MB", "download MB", "written MB"))
+    for event in sorted(steps, key=lambda event: event["start"]):
+        status = " skipped" if event.get("skipped") else " FAILED" if event.get("failed") else ""
+        puts("%s %-28s %10.1f %10.1f %10.1f %12.1f %12s%s" % (
+            "*" if event["name"] in critical else " ", event["name"], event["wall"], event["cpu"],
+            event["running_max_rss_kb"] / 1024.0, event["downloaded"] / 1024.0 ** 2,
+            "%.1f" % (event["written"] / 1024.0 ** 2) if event["written"] is not None else "-", status))
+    puts("  run max MB: largest memory of the installer or of a command so far in this process")
+    puts("  critical path: %.1fs, %s" % (sum(dict((e["name"], e["wall"]) for e in steps)[step] for step in critical),
+                                        " > ".join(critical)))
+
+def _critical_path(walls):
+    """Return the chain of deploy steps, each requiring the one before it, with the longest
+    total wall time in walls, a dictionary of step to wall time.
+    """
+    longest = {}
+    for step, requires in _deploy_steps(extras=True):
+        if step not in walls:
+            continue
+        done = [r for r in requires if r in longest]
+        if done:
+            before = max(done, key=lambda r: longest[r][0])
+            longest[step] = (longest[before][0] + walls[step], longest[before][1] + [step])
+        else:
+            longest[step] = (walls[step], [step])
+    if not longest:
+        return []
+    return max(longest.values())[1]
+
 # ================================================================================
 # == Fabric instructions
 
+@_traced("task", summary=True)
 def deploy():
     """Setup environment, install dependencies and tools
     and deploy chipseq pipeline
@@ -76,10 +321,12 @@ def deploy():
     setup_environment()
     install_dependencies()
     install_tools()
+    compile_libraries()
     install_data()
     install_chipseq()
     install_test()
 
+@_traced("task", summary=True)
 def deploy_withextras():
     """Setup environment, install dependencies and tools
     and deploy chipseq pipeline with extras such as atlas and openssl
@@ -89,13 +336,446 @@ def deploy_withextras():
     install_openssl() # needed for ucsc tools and perl
     install_dependencies()
     install_tools()
+    compile_libraries()
     install_data()
     install_chipseq()
     install_test()
 
+@_traced("task", summary=True)
+def deploy_parallel(jobs=None, extras=False):
+    """Deploy chipseq pipeline running independent install steps at the same time
+    Usage:
+        fab -f scripts/chipseq_installer.py local deploy_parallel:jobs=8
+        fab -f scripts/chipseq_installer.py local deploy_parallel:jobs=8,extras=True
+    The output of each step goes to logs/<step>.log
+    """
+    if jobs is None:
+        jobs = env.jobs
+    steps = _deploy_steps(_as_bool(extras))
+    _run_steps(steps, int(jobs))
+
+def force(*steps):
+    """Reinstall steps, and every step that needs them, on the next deploy
+    Installed steps are skipped by deploy when their inputs have not changed.
+    Usage:
+        fab -f scripts/chipseq_installer.py local force:install_meme deploy
+    """
+    for step in _step_dependents(steps):
+        puts("Removing completion stamp of %s" % step)
+        _remove(_stamp_file(step))
+
+def rollout(targets='', targets_file=None, jobs=None, dest=None):
+    """Copy the installed pipeline from this build host to target hosts at the same time
+    Only the files that changed are sent, with rsync over ssh, to the same directory on
+    each target: env.sh, config.ini, scripts and compiled tools hold the project directory,
+    so dest can only be the project directory. Targets are separated by ';' or listed one
+    per line in targets_file.
+    Usage:
+        fab -f scripts/chipseq_installer.py local deploy rollout:targets="node1;node2"
+        fab -f scripts/chipseq_installer.py local rollout:targets_file=nodes.txt,jobs=16
+    The output of each copy goes to logs/rollout-<target>.log
+    """
+    hosts = [host.strip() for host in targets.split(";") if host.strip()]
+    if targets_file:
+        with open(targets_file) as f:
+            hosts.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    if not hosts:
+        abort("No target hosts given, use rollout:targets=\"node1;node2\" or rollout:targets_file=nodes.txt")
+    if dest and os.path.normpath(dest) != env.project_dir:
+        abort("Cannot roll out to %s, the installed files hold the project directory %s" % (dest, env.project_dir))
+    _make_dir(env.log_dir)
+    _run_pool(_rollout_host, [(host, env.project_dir) for host in hosts], jobs or env.rollout_jobs)
+    puts("Rolled out %s to %d hosts" % (env.project_dir, len(hosts)))
+
+def switch_versions(set_id=None):
+    """Switch the compiled tools to the versions of another set, the previous one by default
+    The sets are in versions/sets, each with a manifest.json giving the version of each step.
+    The switch makes a new set, so switching again without set_id goes back.
+    Usage:
+        fab -f scripts/chipseq_installer.py local switch_versions
+        fab -f scripts/chipseq_installer.py local switch_versions:set_id=3
+    """
+    with _versions_lock():
+        set_id = set_id or _active_versions().get("previous")
+        if not set_id or int(set_id) not in _version_sets():
+            abort("No versions set %s, the sets are in %s" % (set_id or "before this one", _versions_path("sets")))
+        with open(_versions_path("sets", str(set_id), "manifest.json")) as f:
+            _switch_versions(json.load(f)["components"])
+
+def prune_versions(keep=3):
+    """Remove the versions of compiled tools only used by sets older than the last keep sets
+    Versions installed by a deploy that has not switched to them yet are kept.
+    Usage:
+        fab -f scripts/chipseq_installer.py local prune_versions:keep=2
+    """
+    if int(keep) < 1:
+        abort("prune_versions keeps at least the last set, keep=%s" % keep)
+    with _versions_lock():
+        set_ids = _version_sets()
+        kept = set(set_ids[-int(keep):] + [int(_active_versions().get("set", 0))])
+        used = set(_pending_versions().values())
+        for set_id in set_ids:
+            if set_id in kept:
+                with open(_versions_path("sets", str(set_id), "manifest.json")) as f:
+                    used.update(json.load(f)["components"].values())
+            else:
+                lrun("rm -rf %s" % _versions_path("sets", str(set_id)))
+        for name in os.listdir(_versions_path()):
+            # versions being built or unpacked end in .part
+            if name not in used and name not in ("sets", "current", ".lock", "pending.json") and not name.endswith(".part"):
+                puts("Removing %s" % _versions_path(name))
+                lrun("rm -rf %s" % _versions_path(name))
+
+def probe_environment():
+    """Write the installed python, R and perl libraries and executables to installed.json
+    Each interpreter is started once. Install steps read the same probe to skip what
+    is installed already.
+    Usage:
+        fab -f scripts/chipseq_installer.py local probe_environment
+    """
+    _probe_cache.clear()
+    for section in PROBES:
+        _installed(section)
+    puts("Installed libraries and executables written to %s" % _manifest_file())
+
+# Install steps run by deploy_parallel with the steps each of them needs to be done first.
+# The order of this list is the order used by deploy when steps are run one after another.
+DEPLOY_STEPS = [
+    ("setup_environment", []),
+    ("install_tar", ["setup_environment"]),
+    ("install_perl", ["setup_environment"]),
+    ("install_perl_libraries", ["install_perl"]),
+    ("install_cairo", ["install_tar"]), # cairo is a .tar.xz archive
+    ("install_r", ["install_cairo"]),
+    ("install_r_libraries", ["install_r"]),
+    ("install_python_libraries", ["install_r"]), # rpy2 and rpy link against R
+    ("install_rsync", ["setup_environment"]),
+    ("install_git", ["setup_environment"]),
+    ("install_java", ["setup_environment"]),
+    ("install_workflow", ["setup_environment"]),
+    ("install_ucsc_tools", ["setup_environment"]),
+    ("install_samtools", ["setup_environment"]),
+    ("install_bedtools", ["setup_environment"]),
+    ("install_picard", ["setup_environment"]),
+    ("install_bwa", ["setup_environment"]),
+    ("install_macs", ["install_python_libraries"]), # avoid two concurrent installs in the virtualenv
+    ("install_meme", ["install_perl_libraries"]),
+    ("compile_libraries", ["install_r_libraries", "install_macs", "install_sicer"]),
+    ("install_sicer", ["setup_environment"]),
+    ("install_gtf2bed", ["setup_environment"]),
+    ("install_genomes", ["setup_environment"]),
+    ("install_genome_indexes", ["install_genomes", "install_ucsc_tools"]),
+    ("install_bwa_indexes", ["install_genome_indexes", "install_bwa"]),
+    ("install_gene_intervals", ["install_genomes"]),
+    ("configure_meme", ["setup_environment"]),
+    ("install_chipseq_pipeline", ["setup_environment"]),
+    ("update_config", ["install_chipseq_pipeline"]),
+    ("install_test", ["setup_environment"]),
+]
+
+# Extra steps run by deploy_withextras, with the existing steps that need them.
+EXTRA_STEPS = [
+    ("install_atlas", ["setup_environment"], ["install_python_libraries"]), # needed for SciPy
+    ("install_openssl", ["setup_environment"], ["install_perl", "install_ucsc_tools"]),
+]
+
+def _as_bool(value):
+    """Convert a fabric task argument, always given as a string on the command line, to a boolean.
+    """
+    if isinstance(value, basestring):
+        return value.lower() in ("true", "yes", "y", "1")
+    return bool(value)
+
+def _step_requirements(step):
+    """Return the steps step needs: its deploy requirements and the extra steps it
+    needs when they have been installed.
+    """
+    requires = list(dict(DEPLOY_STEPS).get(step, []))
+    for extra, extra_requires, needed_by in EXTRA_STEPS:
+        if extra == step:
+            requires.extend(extra_requires)
+        elif step in needed_by and lexists(_stamp_file(extra)):
+            requires.append(extra)
+    return requires
+
+def _step_dependents(steps):
+    """Return steps and every step that needs them, directly or not.
+    """
+    all_steps = _deploy_steps(extras=True)
+    dependents = set(steps)
+    changed = True
+    while changed:
+        changed = False
+        for step, requires in all_steps:
+            if step not in dependents and dependents.intersection(requires):
+                dependents.add(step)
+                changed = True
+    return [step for step, requires in all_steps if step in dependents] + sorted(set(steps) - set(dict(all_steps)))
+
+def _deploy_steps(extras=False):
+    """Return the deploy steps as an ordered list of (step, required steps).
+    """
+    steps = [(step, list(requires)) for step, requires in DEPLOY_STEPS]
+    if extras:
+        required_by = {}
+        for step, requires, needed_by in EXTRA_STEPS:
+            for other in needed_by:
+                required_by.setdefault(other, []).append(step)
+        steps = [(step, requires + required_by.get(step, [])) for step, requires in steps]
+        steps[1:1] = [(step, requires) for step, requires, needed_by in EXTRA_STEPS]
+    return steps
+
+# number of lines of the log of a failed step printed by deploy_parallel
+STEP_LOG_TAIL = 20
+
+def _run_step(step):
+    """Run one install step in a worker process with its output sent to logs/<step>.log.
+    Return (step, succeeded, error message, last lines of the log).
+    """
+    log_path = os.path.join(env.log_dir, "%s.log" % step)
+    log_file = open(log_path, 'w')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log_file.fileno(), sys.stdout.fileno())
+    os.dup2(log_file.fileno(), sys.stderr.fileno())
+    try:
+        globals()[step]()
+        error = None
+    except SystemExit as e:
+        # fabric abort() writes its message to the log before raising SystemExit
+        error = "exit code %s" % e.code
+    except Exception as e:
+        traceback.print_exc()
+        error = "%s: %s" % (e.__class__.__name__, e)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if error is None:
+        return step, True, "", ""
+    with open(log_path) as f:
+        tail = f.read().splitlines()[-STEP_LOG_TAIL:]
+    fatal = [line for line in tail if line.startswith("Fatal error:")]
+    return step, False, fatal[-1] if fatal else error, "\n".join(tail)
+
+def _run_steps(steps, jobs):
+    """Run install steps in a pool of jobs processes, starting each step as soon as
+    the steps it requires are done. Stop starting new steps on the first failure,
+    wait for the running ones to finish and abort.
+    """
+    _make_dir(env.log_dir)
+    pending = [step for step, requires in steps]
+    requirements = dict(steps)
+    done = set()
+    running = {}
+    failures = []
+    pool = multiprocessing.Pool(jobs, maxtasksperchild=1)
+    try:
+        while (pending and not failures) or running:
+            if not failures:
+                for step in [s for s in pending if set(requirements[s]) <= done]:
+                    if len(running) >= jobs:
+                        break
+                    print("[deploy] starting %s (log: %s)" % (step, os.path.join(env.log_dir, "%s.log" % step)))
+                    running[step] = pool.apply_async(_run_step, (step,))
+                    pending.remove(step)
+                if pending and not running:
+                    abort("Steps %s require steps that are not part of the deploy" % ", ".join(pending))
+            time.sleep(1)
+            for step, result in list(running.items()):
+                if result.ready():
+                    del running[step]
+                    step, succeeded, message, tail = result.get()
+                    if succeeded:
+                        print("[deploy] finished %s" % step)
+                        done.add(step)
+                    else:
+                        print("[deploy] FAILED %s: %s" % (step, message))
+                        print("[deploy] last lines of %s:\n%s" % (os.path.join(env.log_dir, "%s.log" % step),
+                                                                 "\n".join("    " + line for line in tail.splitlines())))
+                        failures.append(step)
+    finally:
+        pool.close()
+        pool.join()
+    if failures:
+        abort("Deploy stopped, failed steps: %s; see logs in %s" % (", ".join(failures), env.log_dir))
+
+# Files and directories of the project directory copied to the target hosts by rollout,
+# when they exist. Downloads, build directories and logs stay on the build host.
+ROLLOUT_PATHS = ["versions", "bin", "lib", "lib64", "include", "share", "man", "annotation", "stamps",
+                 "chipseq-pipeline-master", "env.sh", "env_csh.sh"]
+
+def _rsync_progress_option(rsync):
+    """Return the rsync option showing the progress of the whole copy, --info=progress2,
+    or the progress of each file with rsync older than 3.1.
+    """
+    try:
+        output = subprocess.Popen([rsync, "--version"], stdout=subprocess.PIPE).communicate()[0]
+    except OSError:
+        output = b""
+    match = re.search(br"version (\d+)\.(\d+)", output)
+    if match and (int(match.group(1)), int(match.group(2))) >= (3, 1):
+        return "--info=progress2"
+    return "--progress"
+
+def _rollout_host(host, dest):
+    """Copy ROLLOUT_PATHS to dest on host with rsync, sending only what changed since
+    the last rollout, and deleting what was removed.
+    """
+    log_file = os.path.join(env.log_dir, "rollout-%s.log" % host)
+    paths = [path for path in ROLLOUT_PATHS if lexists(os.path.join(env.project_dir, path))]
+    rsync = _which("rsync") or "rsync"
+    command = [rsync, "-aH", "--delete", "--relative", "--partial", "--stats",
+               _rsync_progress_option(rsync), "-e", "ssh -o BatchMode=yes",
+               "--rsync-path", "mkdir -p %s && rsync" % dest] + \
+              ["./%s" % path for path in paths] + ["%s:%s/" % (host, dest)]
+    print("[rollout] starting %s (log: %s)" % (host, log_file))
+    start = time.time()
+    with open(log_file, 'w') as log:
+        returncode = subprocess.call(command, cwd=env.project_dir, stdout=log, stderr=subprocess.STDOUT)
+    if returncode != 0:
+        print("[rollout] FAILED %s: rsync exit code %d" % (host, returncode))
+        raise Exception("rsync exit code %d, see %s" % (returncode, log_file))
+    print("[rollout] finished %s in %ds" % (host, time.time() - start))
+
 # ================================================================================
 # == Decorators and build utilities
 
+def _stamped(**inputs):
+    """Decorator that skips an install step when it has been completed with the same inputs.
+    The completion stamp written in env.stamp_dir records the step arguments (urls,
+    versions, options), the inputs given to the decorator, evaluated when the step runs
+    if they are callables, the checksum of the step code and the stamps of the steps it
+    needs. A step is run again when any of these change, or when one of the steps it
+    needs has been run again.
+    Arguments given to the step with --set step_args replace its defaults.
+    """
+    def argcatcher(func):
+        @functools.wraps(func)
+        def decorator(*args, **kwargs):
+            step = func.__name__
+            kwargs = dict(_step_args(step), **kwargs)
+            with _trace("step", step) as event:
+                code = _sha256(inspect.getsource(_unwrap(func)))
+                record = _stamp_record(step, code, inspect.getcallargs(_unwrap(func), *args, **kwargs), inputs)
+                stamp = _read_stamp(step)
+                if stamp and stamp["digest"] == record["digest"]:
+                    puts("Skipping %s, already installed with the same inputs" % step)
+                    event["skipped"] = True
+                    return
+                _remove(_stamp_file(step))
+                # the build directory may have been cleaned since setup_environment created it,
+                # e.g. on node-local scratch, while its stamp still matches
+                _make_dir(env.tmp_dir)
+                try:
+                    with _compiler_cache(), _deferred_version_switch():
+                        result = func(*args, **kwargs)
+                finally:
+                    # the step changed what is installed
+                    _probe_cache.clear()
+                _write_stamp(step, record)
+                return result
+        decorator.__wrapped__ = func
+        return decorator
+    return argcatcher
+
+def _step_args(step):
+    """Return the arguments of step given with --set step_args="install_bwa:version=0.7.17;...".
+    """
+    args = {}
+    for entry in str(env.step_args or "").split(";"):
+        name, _, arg = entry.strip().partition(":")
+        if name == step and "=" in arg:
+            arg_name, _, value = arg.partition("=")
+            args[arg_name.strip()] = value.strip()
+    return args
+
+def _stamp_file(step):
+    return os.path.join(env.stamp_dir, "%s.json" % step)
+
+def _read_stamp(step):
+    if not lexists(_stamp_file(step)):
+        return None
+    with open(_stamp_file(step)) as f:
+        return json.load(f)
+
+def _stamp_record(step, code, args, inputs):
+    record = {"step": step,
+              "code": code,
+              "project_dir": env.project_dir,
+              "args": args,
+              "inputs": dict((name, value() if callable(value) else value) for name, value in inputs.items()),
+              "requires": {}}
+    for required in _step_requirements(step):
+        stamp = _read_stamp(required)
+        record["requires"][required] = stamp and stamp["id"]
+    record["digest"] = _sha256(json.dumps(record, sort_keys=True))
+    return record
+
+def _write_stamp(step, record):
+    _make_dir(env.stamp_dir)
+    stamp = dict(record, finished=time.strftime("%Y-%m-%d %H:%M:%S"))
+    # the id changes every time the step is run so that the steps needing it run again
+    stamp["id"] = _sha256("%s %s" % (record["digest"], time.time()))
+    with open("%s.part" % _stamp_file(step), 'w') as f:
+        json.dump(stamp, f, indent=1, sort_keys=True)
+    os.rename("%s.part" % _stamp_file(step), _stamp_file(step))
+
+def _artifact(**inputs):
+    """Decorator that installs a compiled step from the build artifact cache.
+    The step is built once, installing into a staging directory, and the files it
+    installed are packed into an artifact in env.cache_dir/artifacts keyed by the step
+    arguments (urls, versions, options), the inputs given to the decorator, the step code,
+    the compiler and the architecture. A later install with the same key, in this or any
+    other project directory sharing the cache, unpacks the artifact instead of building.
+    With env.versioned, the step is installed in its own version directory, see
+    _switch_versions, and a version installed before is switched to without building.
+    Install steps write to the staging directory with _make_install() and _staged(path).
+    """
+    def argcatcher(func):
+        @functools.wraps(func)
+        def decorator(*args, **kwargs):
+            if not _as_bool(env.artifacts) and not _as_bool(env.versioned):
+                return func(*args, **kwargs)
+            step = func.__name__
+            key = _artifact_key(step, _sha256(inspect.getsource(func)),
+                                inspect.getcallargs(func, *args, **kwargs), inputs)
+            version_dir = _version_dir(key) if _as_bool(env.versioned) else None
+            if version_dir:
+                lrun("rm -rf %s" % _tmp_name(version_dir))
+                if lexists(version_dir) or (_as_bool(env.artifacts) and
+                                            _unpack_artifact(step, key, _tmp_name(version_dir))):
+                    return _install_version(step, version_dir)
+            elif _unpack_artifact(step, key):
+                return
+            stage_dir = os.path.join(env.tmp_dir, "stage", step)
+            lrun("rm -rf %s" % stage_dir)
+            _make_dir(stage_dir + env.project_dir)
+            env.stage_dir = stage_dir
+            env.version_dir = version_dir and _tmp_name(version_dir)
+            try:
+                result = func(*args, **kwargs)
+                _sync_stage()
+            finally:
+                env.stage_dir = env.version_dir = None
+            if not _version_files(stage_dir + env.project_dir):
+                # an empty artifact or version would remove the installed step
+                abort("%s installed nothing in %s" % (step, stage_dir))
+            if _as_bool(env.artifacts):
+                _pack_artifact(step, key, stage_dir + env.project_dir)
+            lrun("rm -rf %s" % stage_dir)
+            if version_dir:
+                _install_version(step, version_dir)
+            return result
+        decorator.__wrapped__ = func
+        return decorator
+    return argcatcher
+
+def _unwrap(func):
+    # functools.wraps only sets __wrapped__ from python 3.2
+    while hasattr(func, "__wrapped__"):
+        func = func.__wrapped__
+    return func
+
+@_stamped(template=lambda: _sha256_file(os.path.join(env.chipseq_installer, env.env_setup)))
 def setup_environment():
     """Copy adhoc environment variables, set CHIPSEQ_ROOT path and create tmp directory
     """
@@ -108,22 +788,20 @@ def setup_environment():
 def lexists(path):
     return os.path.exists(path)
 
-def vlrun(command):
+def vlrun(command, capture=False):
     """Run a command in a virtual environment. This prefixes the run command with the source command.
     Usage:
         vlrun('pip install tables')
     """
     source = 'source %(project_dir)s/bin/%(activate)s && source %(project_dir)s/%(env_setup)s && ' % env
-    return lrun(source + command, shell='%s' % env.shell)    
+    return lrun(source + command, capture=capture, shell='%s' % env.shell)    
 
 def _if_not_python_lib(library):
     """Decorator that checks if a python library is installed.
     """
     def argcatcher(func):
         def decorator(*args, **kwargs):
-            with settings(warn_only=True):
-                result = vlrun("python -c 'import %s'" % library)
-            if result.failed:
+            if library.lower() not in _installed("python"):
                 return func(*args, **kwargs)
         return decorator
     return argcatcher
@@ -133,73 +811,1077 @@ def _make_dir(path):
         if lrun("test -d %s" % path).failed:
             lrun("mkdir -p %s" % path)
 
-def _get_expected_file(path, url):
-    tar_file = os.path.split(url)[-1]
-    safe_tar = "--pax-option='delete=SCHILY.*,delete=LIBARCHIVE.*'"
-    exts = {(".tar.gz", ".tgz") : "tar %s -xzpf" % safe_tar,
-            (".tar.xz",) : "tar %s -xJpf" % safe_tar,
-            (".tar.bz2",): "tar %s -xjpf" % safe_tar,
-            (".zip",) : "unzip -o"}
-    for ext_choices, tar_cmd in exts.iteritems():
-        for ext in ext_choices:
-            if tar_file.endswith(ext):
-                return tar_file, tar_file[:-len(ext)], tar_cmd
-    raise ValueError("Did not find extract command for %s" % url)
-
-def _safe_dir_name(path, dir_name, need_dir=True):
-    replace_try = ["", "-src", "_core"]
-    for replace in replace_try:
-        check = dir_name.replace(replace, "")
-        if lexists(os.path.join(path, check)):
-            return check
-        # still couldn't find it, it's a nasty one
-        for check_part in (dir_name.split("-")[0].split("_")[0],
-                           dir_name.split("-")[-1].split("_")[-1],
-                           dir_name.split(".")[0]):
-            with settings(hide('warnings', 'running', 'stdout', 'stderr'),
-                          warn_only=True):
-                dirs = lrun("ls -d1 %s/*%s*/" % (path, check_part)).split("\n")
-                dirs = [x for x in dirs if "cannot access" not in x and "No such" not in x]
-                if len(dirs) == 1:
-                    return dirs[0]
-                if need_dir:
-                    raise ValueError("Could not find directory %s" % dir_name)
+# Compressed file extensions with their decompressors, the parallel ones first, used
+# when they are installed
+DECOMPRESSORS = [((".gz", ".tgz"), [["pigz", "-dc"], ["gzip", "-dc"]]),
+                 ((".bz2",), [["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]]),
+                 ((".xz",), [["pixz", "-d"], ["xz", "-dc"]])]
+
+def _decompress_command(name):
+    """Return the command decompressing stdin to stdout for the compressed file name,
+    None when none of its decompressors is installed.
+    """
+    for extensions, commands in DECOMPRESSORS:
+        if name.endswith(extensions):
+            for command in commands:
+                program = _which(command[0])
+                if program:
+                    return [program] + command[1:]
+            return None
+    raise ValueError("Did not find extract command for %s" % name)
 
 def _fetch_and_unpack(path, url, need_dir=True, wget_options=''):
-    tar_file, dir_name, tar_cmd = _get_expected_file(path, url)
-    if lexists(os.path.join(path, tar_file)):
-       lrun("rm -rf %s" % os.path.join(path, tar_file)) 
-    lrun("wget --no-check-certificate %s %s" % (wget_options, url))
-    vlrun("%s %s" % (tar_cmd, tar_file))
-    return _safe_dir_name(path, dir_name, need_dir)
-    
+    """Unpack the archive of url in path as it is downloaded, or read from the download
+    cache, and return the directory it unpacks to, read from its list of members. Tar
+    archives are piped to tar through pigz, lbzip2, pbzip2 or pixz when installed.
+    """
+    if url.endswith(".zip"):
+        # the member list of a zip archive is at its end, it cannot be streamed
+        cached_file = _fetch_cached(url, wget_options=wget_options)
+        lrun("unzip -o -q %s -d %s" % (cached_file, path))
+        members = zipfile.ZipFile(cached_file).namelist()
+    else:
+        for attempt in range(int(env.download_retries)):
+            try:
+                members = _stream_unpack(url, path, wget_options)
+                break
+            except ValueError as e:
+                # corrupted cache file, removed from the cache and downloaded again
+                warn(str(e))
+        else:
+            abort("Failed to unpack %s after %s attempts" % (url, env.download_retries))
+    dir_name = _top_dir(members)
+    if dir_name is None and need_dir:
+        abort("%s does not unpack to a single directory" % url)
+    return dir_name
+
+def _stream_unpack(url, path, wget_options=''):
+    """Unpack the tar archive of url in path as it arrives and return its member names.
+    """
+    decompress_command = _decompress_command(url)
+    if decompress_command is None:
+        abort("No decompressor found for %s" % url)
+    members_file = _tmp_name(os.path.join(path, "%s.members" % os.path.split(url)[-1]))
+    try:
+        # tar lists the members on stdout, to a file so that the pipe never fills up
+        with open(members_file, 'w+') as members:
+            decompress = subprocess.Popen(decompress_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            tar = subprocess.Popen([_which("tar") or "tar", "-x", "-v", "-p", "-f", "-", "-C", path,
+                                    "--pax-option=delete=SCHILY.*,delete=LIBARCHIVE.*"],
+                                   stdin=decompress.stdout, stdout=members)
+            decompress.stdout.close()
+            try:
+                _fetch_stream(url, [decompress.stdin], wget_options)
+            finally:
+                decompress.stdin.close()
+                returncodes = decompress.wait(), tar.wait()
+            if returncodes != (0, 0):
+                abort("Failed to unpack %s" % url)
+            members.seek(0)
+            return [line.rstrip("\n") for line in members]
+    finally:
+        _remove(members_file)
+
+def _top_dir(members):
+    """Return the directory all the members of an archive are in, None when there is none.
+    """
+    names = [name[2:] if name.startswith("./") else name for name in members]
+    names = [name for name in names if name.strip("./")]
+    tops = set(name.split("/")[0] for name in names)
+    if len(tops) == 1 and any("/" in name.rstrip("/") for name in names):
+        return tops.pop()
+    return None
+
 def _fetch(path, url):
-    tar_file = os.path.split(url)[-1]
-    if not lexists(os.path.join(path, tar_file)):
-        lrun("wget -r %s -O %s" % (url, os.path.join(path, tar_file)))
+    tar_file = os.path.join(path, os.path.split(url)[-1])
+    cached_file = _fetch_cached(url)
+    if not (lexists(tar_file) and os.path.samefile(tar_file, cached_file)):
+        _link_or_copy(cached_file, tar_file)
 
 def _fetch_and_unpack_genome(path, url):
-    tar_file = os.path.split(url)[-1]
-    if not lexists(os.path.join(path, tar_file)):
-        lrun("wget -r %s -O %s" % (url, tar_file))
-        lrun("gzip -d -r  %s" % tar_file)
+    """Download a gzip genome or annotation file and decompress it in path as it arrives,
+    without writing the compressed file anywhere else than in the download cache, or
+    compress it again in BGZF with env.bgzip.
+    The file is checked against the Ensembl CHECKSUMS file of its directory on the way
+    and downloaded again, up to env.download_retries times, when it does not match.
+    """
+    name = os.path.split(url)[-1][:-len(".gz")]
+    unpacked_file = os.path.join(path, _stored_name(name))
+    tmp_file = _tmp_name(unpacked_file)
+    index_file = _tmp_name(unpacked_file + ".gzi") if unpacked_file.endswith(".gz") else None
+    expected_sum = _ensembl_checksums(url).get(os.path.split(url)[-1])
+    if not expected_sum:
+        warn("No Ensembl checksum found for %s, it will not be checked" % url)
+    try:
+        for attempt in range(int(env.download_retries)):
+            try:
+                _fetch_decompressed(url, tmp_file, expected_sum, index_file)
+                break
+            except ValueError as e:
+                # corrupted download or cache file, removed from the cache and downloaded again
+                warn(str(e))
+        else:
+            abort("Failed to download %s after %s attempts" % (url, env.download_retries))
+        if index_file:
+            os.rename(index_file, unpacked_file + ".gzi")
+        os.rename(tmp_file, unpacked_file)
+        # the file stored the other way by an earlier install
+        for stale_name in ([name] if index_file else [name + ".gz", name + ".gz.gzi"]):
+            _remove(os.path.join(path, stale_name))
+    finally:
+        _remove(tmp_file)
+        if index_file:
+            _remove(index_file)
+
+def _stored_name(name):
+    """Return the name of the decompressed genome or annotation file name as stored by
+    install_genomes, with .gz when env.bgzip stores it in BGZF.
+    """
+    return name + ".gz" if _as_bool(env.bgzip) else name
 
-def _configure_make(env, options=''):
-    vlrun("./configure --disable-error --prefix=%s %s" % (env.project_dir, options))
-    vlrun("make")
-    vlrun("make install")
+def _fetch_decompressed(url, dest, expected_sum=None, index=None):
+    """Decompress url to dest, or compress it again to dest in BGZF and write its block
+    offsets to index when given.
+    """
+    checksum = _BsdSum()
+    if index:
+        # threads of bgzf.py shared between the files downloaded at the same time
+        threads = max(1, multiprocessing.cpu_count() // int(env.download_jobs))
+        compressor = subprocess.Popen([sys.executable, inspect.getsourcefile(bgzf), "-@", str(threads), dest, index],
+                                      stdin=subprocess.PIPE)
+        out = compressor.stdin
+    else:
+        out = open(dest, 'wb')
+    with out:
+        gunzip = subprocess.Popen(_decompress_command(url), stdin=subprocess.PIPE, stdout=out)
+        try:
+            cached_file = _fetch_stream(url, [gunzip.stdin, checksum])
+        finally:
+            gunzip.stdin.close()
+            returncode = gunzip.wait()
+            file_sum = checksum.result()
+    if index and compressor.wait() != 0:
+        abort("Failed to compress %s in BGZF" % url)
+    if expected_sum and file_sum is None:
+        # sum failed, the file is checked again on the next attempt
+        raise ValueError("Checksum of %s could not be computed with sum -r, expected %s %s" % ((url,) + expected_sum))
+    if expected_sum and file_sum != expected_sum:
+        _remove(cached_file)
+        raise ValueError("Checksum of %s is %s %s, expected %s %s" % ((url,) + file_sum + expected_sum))
+    if returncode != 0:
+        abort("Failed to decompress %s" % url)
+
+class _BsdSum(object):
+    """File like object computing the BSD checksum and number of 1K blocks of the data
+    written to it, as listed by sum in Ensembl CHECKSUMS files.
+    """
+    def __init__(self):
+        self.process = subprocess.Popen(["sum", "-r"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def write(self, block):
+        self.process.stdin.write(block)
 
-def _get_install(url, env, make_command, make_options=''):
+    def result(self):
+        output = self.process.communicate()[0]
+        if self.process.returncode != 0:
+            return None
+        checksum, blocks = output.split()[:2]
+        return int(checksum), int(blocks)
+
+_ensembl_checksums_lock = threading.Lock()
+_ensembl_checksums_cache = {}
+
+def _ensembl_checksums(url):
+    """Return the checksums of the files in the Ensembl directory of url read from its
+    CHECKSUMS file, as a dictionary of file name to (checksum, blocks).
+    """
+    checksums_url = "%s/CHECKSUMS" % os.path.dirname(url)
+    with _ensembl_checksums_lock:
+        if checksums_url not in _ensembl_checksums_cache:
+            checksums = {}
+            try:
+                with open(_fetch_cached(checksums_url)) as f:
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) == 3:
+                            checksums[fields[2]] = (int(fields[0]), int(fields[1]))
+            except (Exception, SystemExit) as e:
+                warn("Could not read %s: %s" % (checksums_url, e))
+            _ensembl_checksums_cache[checksums_url] = checksums
+    return _ensembl_checksums_cache[checksums_url]
+
+def _which(program):
+    for path in [env.bin_dir] + os.environ.get("PATH", "").split(os.pathsep):
+        executable = os.path.join(path, program)
+        if os.path.isfile(executable) and os.access(executable, os.X_OK):
+            return executable
+    return None
+
+def _run_pool(func, args_list, jobs):
+    """Call func(*args) for every args of args_list in a pool of jobs threads. Abort when
+    any of the calls failed, once they are all done.
+    """
+    pool = multiprocessing.pool.ThreadPool(int(jobs))
+    try:
+        errors = [error for error in pool.map(_safe_call, [(func, args) for args in args_list]) if error]
+    finally:
+        pool.close()
+        pool.join()
+    if errors:
+        abort("\n".join(errors))
+
+def _safe_call(call):
+    """Call func(*args) for call (func, args) and return an error message when it fails.
+    """
+    func, args = call
+    try:
+        func(*args)
+    except (Exception, SystemExit) as e:
+        # fabric abort() raises SystemExit which would stop the pool worker
+        return "%s%r failed: %s %s" % (func.__name__, tuple(args), e.__class__.__name__, e)
+
+def _make(target='', parallel=True):
+    """Return the make command for target, running env.make_jobs jobs in parallel.
+    Steps known to break with a parallel make pass parallel=False, to _get_install and
+    _configure_make too. Parallel makes are also limited by the load average so that
+    steps run by deploy_parallel do not overload the machine.
+    """
+    jobs = int(env.make_jobs)
+    if parallel and jobs > 1:
+        return ("make -j%d -l%d %s" % (jobs, multiprocessing.cpu_count(), target)).strip()
+    return ("make %s" % target).strip()
+
+def _make_install(variable="DESTDIR"):
+    """Return the make install command, installing in the staging directory of a step
+    building an artifact. variable is the make variable prefixing the install paths.
+    """
+    if env.get("stage_dir"):
+        return _make("install %s=%s" % (variable, env.stage_dir), parallel=False)
+    return _make("install", parallel=False)
+
+def _staged(path):
+    """Return where a step writes path, in its staging directory when building an artifact.
+    """
+    if env.get("stage_dir"):
+        _make_dir(env.stage_dir + path)
+        return env.stage_dir + path
+    return path
+
+def _sync_stage():
+    """Copy what a step building an artifact installed so far into the project directory,
+    or into its version directory, for steps building several components that need each other.
+    """
+    if env.get("version_dir"):
+        _make_dir(env.version_dir)
+        lrun("cp -a %s/. %s" % (env.stage_dir + env.project_dir, env.version_dir))
+        # files installed for the first time are linked for the next components of the step,
+        # the others stay in their active version until the step is switched to
+        for name in _version_files(env.version_dir):
+            if not os.path.lexists(os.path.join(env.project_dir, name)):
+                _symlink(os.path.join(env.version_dir, name), os.path.join(env.project_dir, name))
+    elif env.get("stage_dir"):
+        lrun("cp -a %s/. %s" % (env.stage_dir + env.project_dir, env.project_dir))
+
+def _configure_make(env, options='', parallel=True):
+    vlrun("./configure --disable-error --prefix=%s %s" % (env.project_dir, options))
+    vlrun(_make(parallel=parallel))
+    vlrun(_make_install())
+    _sync_stage()
+
+@contextmanager
+def _compiler_cache():
+    """Run the compilers through ccache when it is installed and env.ccache is set, with
+    links to ccache named after the compilers put first in the PATH, so that Makefiles
+    calling gcc directly use it too. Paths below env.tmp_dir are hashed relative to it, so
+    that the builds of other project directories sharing the cache are cache hits.
+    """
+    ccache = _which("ccache")
+    if not (ccache and _as_bool(env.ccache)):
+        yield
+        return
+    bin_dir = os.path.join(env.tmp_dir, "ccache-bin")
+    _make_dir(bin_dir)
+    for compiler in ("cc", "gcc", "c++", "g++"):
+        try:
+            os.symlink(ccache, os.path.join(bin_dir, compiler))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    ccache_dir = env.ccache_dir or os.path.join(env.cache_dir, "ccache")
+    with shell_env(CCACHE_DIR=ccache_dir, CCACHE_BASEDIR=env.tmp_dir, CCACHE_NOHASHDIR="1"):
+        with path(bin_dir, behavior="prepend"):
+            yield
+
+def _get_install(url, env, make_command, make_options='', parallel=True):
     """Retrieve source from a URL and install in our system directory.
+    Steps whose build breaks with a parallel make pass parallel=False, see _make.
     """
     with lcd(env.tmp_dir):
         dir_name = _fetch_and_unpack(env.tmp_dir, url)
         with lcd(dir_name):
-            make_command(env, make_options)
+            make_command(env, make_options, parallel=parallel)
     
+# ================================================================================
+# == Download cache
+#
+# Downloads are stored once in env.cache_dir/downloads, which can be shared between
+# installs and hosts:
+# - objects/<sha256 of content>: the downloaded files
+# - urls/<sha256 of url>: the sha256 of the content downloaded from this url
+# A download is written to tmp/ and renamed into objects/ once complete and checked,
+# so that the cache never holds partial files.
+
+# start of this run, the downloads used since are not evicted
+_cache_run_start = time.time()
+
+def _cache_path(*parts):
+    return os.path.join(env.cache_dir, "downloads", *parts)
+
+def _sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _cache_lookup(url, sha256=None, verify=True):
+    """Return the cached file of url or None when url is not in the cache, or when the
+    cached file does not match the expected sha256 or, when verify is set, its checksum.
+    """
+    url_file = _cache_path("urls", _sha256(url))
+    if not lexists(url_file):
+        return None
+    with open(url_file) as f:
+        content_sha256 = f.read().split()[0]
+    cached_file = _cache_path("objects", content_sha256)
+    if (sha256 and sha256 != content_sha256) or not lexists(cached_file):
+        return None
+    if verify and _sha256_file(cached_file) != content_sha256:
+        puts("Removing corrupted cache file %s of %s" % (cached_file, url))
+        _remove(cached_file)
+        return None
+    # mark as recently used for the eviction of least recently used files
+    os.utime(cached_file, None)
+    return cached_file
+
+def _cache_store(url, tmp_file, sha256):
+    """Move a complete download into the cache and record it for url.
+    """
+    cached_file = _cache_path("objects", sha256)
+    os.rename(tmp_file, cached_file)
+    url_file = _cache_path("urls", _sha256(url))
+    tmp_url_file = _tmp_name(url_file)
+    with open(tmp_url_file, 'w') as f:
+        f.write("%s %s\n" % (sha256, url))
+    os.rename(tmp_url_file, url_file)
+    _cache_evict(keep=cached_file)
+    return cached_file
+
+def _cache_evict(keep=None):
+    """Remove the least recently used downloads until the downloads of the cache are below
+    env.cache_size GB. Only downloads/objects is counted and evicted: the other directories
+    of the cache, artifacts, indexes, motifs, wheelhouse and ccache, are kept in full.
+    The downloads used since this run started, by this install or another one sharing the
+    cache, are kept even above the limit, as a step running at the same time may be about
+    to link them.
+    """
+    limit = float(env.cache_size) * 1024 ** 3
+    objects_dir = _cache_path("objects")
+    cached_files = []
+    for name in os.listdir(objects_dir):
+        path = os.path.join(objects_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue # removed by another install sharing the cache
+        cached_files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for mtime, size, path in cached_files)
+    for mtime, size, path in sorted(cached_files):
+        if total <= limit or mtime >= _cache_run_start:
+            break
+        if path != keep:
+            puts("Removing %s from download cache" % path)
+            _remove(path)
+            total -= size
+
+def _fetch_cached(url, sha256=None, wget_options=''):
+    """Return the path of url in the download cache, downloading it when not cached yet.
+    The download is checked against sha256 when given.
+    """
+    cached_file = _cache_lookup(url, sha256)
+    if cached_file:
+        puts("Using cached %s" % url)
+        return cached_file
+    return _download(url, [], sha256, wget_options)
+
+def _fetch_stream(url, sinks, wget_options=''):
+    """Give every block of url to sinks, file like objects, reading it from the download
+    cache or as it arrives when downloading it. The cached file is checked on the way and
+    ValueError is raised when it is corrupted. Return the path of url in the cache.
+    """
+    cached_file = _cache_lookup(url, verify=False)
+    if not cached_file:
+        return _download(url, sinks, wget_options=wget_options)
+    puts("Using cached %s" % url)
+    with open(cached_file, 'rb') as source:
+        content_sha256 = _copy_blocks(source, sinks)
+    if content_sha256 != os.path.basename(cached_file):
+        _remove(cached_file)
+        raise ValueError("Removed corrupted cache file %s of %s" % (cached_file, url))
+    return cached_file
+
+def _download(url, sinks, sha256=None, wget_options=''):
+    """Download url in the cache, giving every block to sinks as it arrives.
+    Files larger than env.segment_size MB without sinks are downloaded in segments, see
+    _download_segments. Streamed downloads are not: the segments only complete at the end
+    and the file would be read again in full to give it to the sinks.
+    """
+    for name in ("tmp", "objects", "urls"):
+        _make_dir(_cache_path(name))
+    if not sinks and not wget_options and _host_connections(url) > 1:
+        size = _remote_size(url)
+        if size and size >= float(env.segment_size) * 1024 ** 2:
+            part_file = _download_segments(url, size)
+            if part_file:
+                return _store_segments(url, part_file, sha256)
+    tmp_file = _tmp_name(_cache_path("tmp", _sha256(url)))
+    puts("Downloading %s" % url)
+    try:
+        wget = subprocess.Popen(["wget", "--no-check-certificate", "-q"] + shlex.split(wget_options) + ["-O", "-", _mirror_url(url)],
+                                stdout=subprocess.PIPE)
+        with open(tmp_file, 'wb') as out:
+            content_sha256 = _copy_blocks(wget.stdout, sinks + [out])
+        with _trace_lock:
+            _trace_downloaded[0] += os.path.getsize(tmp_file)
+        if wget.wait() != 0:
+            abort("Failed to download %s" % url)
+        if sha256 and sha256 != content_sha256:
+            abort("Checksum of %s is %s, expected %s" % (url, content_sha256, sha256))
+        return _cache_store(url, tmp_file, content_sha256)
+    finally:
+        _remove(tmp_file)
+
+def _store_segments(url, part_file, sha256=None):
+    """Move the complete download of url in part_file into the cache.
+    """
+    with open(part_file, 'rb') as source:
+        content_sha256 = _copy_blocks(source, [])
+    if sha256 and sha256 != content_sha256:
+        _remove(part_file)
+        abort("Checksum of %s is %s, expected %s" % (url, content_sha256, sha256))
+    for path in ("%s.json" % part_file, "%s.lock" % part_file):
+        _remove(path)
+    return _cache_store(url, part_file, content_sha256)
+
+def _download_segments(url, size):
+    """Download url of size bytes in byte ranges fetched at the same time, one per connection
+    allowed to its host. The progress of each range is saved in a state file next to the
+    partial file, so that an interrupted download resumes where it stopped, even with
+    another install sharing the cache. Return the complete file, or None when another
+    install is downloading url.
+    """
+    part_file = _cache_path("tmp", "%s.segments" % _sha256(url))
+    lock = open("%s.lock" % part_file, 'w')
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            # file systems mounted without locks, downloads of the same url may clash
+        state = _read_segments_state(part_file, url, size)
+        if state:
+            done = sum(segment[2] for segment in state["segments"])
+            puts("Resuming download of %s, %d%% done" % (url, 100 * done / size))
+        else:
+            step = -(-size // _host_connections(url))
+            state = {"url": url, "size": size,
+                     "segments": [[start, min(start + step, size), 0] for start in range(0, size, step)]}
+            with open(part_file, 'wb') as f:
+                f.truncate(size)
+            puts("Downloading %s in %d segments" % (url, len(state["segments"])))
+        progress = _SegmentsProgress(part_file, state)
+        progress.save()
+        segments = [segment for segment in state["segments"] if segment[0] + segment[2] < segment[1]]
+        _run_pool(_download_segment, [(url, part_file, segment, progress) for segment in segments], len(segments) or 1)
+        return part_file
+    finally:
+        lock.close()
+
+def _read_segments_state(part_file, url, size):
+    try:
+        with open("%s.json" % part_file) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if state["url"] != url or state["size"] != size or not lexists(part_file):
+        return None
+    return state
+
+class _SegmentsProgress(object):
+    """Progress of a segmented download, saved in the state file <partial file>.json.
+    The bytes done of a segment are only recorded once written to the partial file.
+    """
+    def __init__(self, part_file, state):
+        self.state_file = "%s.json" % part_file
+        self.state = state
+        self.lock = threading.Lock()
+
+    def update(self, segment, done):
+        with self.lock:
+            with _trace_lock:
+                _trace_downloaded[0] += done - segment[2]
+            segment[2] = done
+            self.save()
+
+    def save(self):
+        with open(_tmp_name(self.state_file), 'w') as f:
+            json.dump(self.state, f)
+        os.rename(_tmp_name(self.state_file), self.state_file)
+
+def _download_segment(url, part_file, segment, progress):
+    """Download the byte range [start, end) of segment (start, end, bytes done) of url into
+    part_file, from where it stopped, trying again up to env.download_retries times.
+    """
+    for attempt in range(int(env.download_retries)):
+        start, end, done = segment
+        try:
+            with open(part_file, 'r+b') as out:
+                out.seek(start + done)
+                for block in _read_range(url, start + done, end):
+                    out.write(block)
+                    done += len(block)
+                    if done - segment[2] >= 16 * 1024 ** 2:
+                        out.flush()
+                        progress.update(segment, done)
+            progress.update(segment, done)
+            if start + done == end:
+                return
+            warn("Download of bytes %d-%d of %s stopped at %d" % (start, end, url, start + done))
+        except (IOError, OSError, EOFError, ftplib.Error) as e:
+            progress.update(segment, done)
+            warn("Download of bytes %d-%d of %s failed: %s" % (start, end, url, e))
+    raise IOError("bytes %d-%d of %s not downloaded after %s attempts, run again to resume"
+                  % (start, end, url, env.download_retries))
+
+def _read_range(url, start, end):
+    """Yield the blocks of the bytes [start, end) of url, with an HTTP range request or an
+    FTP REST command.
+    """
+    url = _mirror_url(url)
+    remaining = end - start
+    if urllib_parse.urlparse(url).scheme == "ftp":
+        ftp = _ftp_connect(url)
+        try:
+            connection = ftp.transfercmd("RETR %s" % urllib_parse.urlparse(url).path, rest=start)
+            try:
+                while remaining > 0:
+                    block = connection.recv(min(remaining, 1024 * 1024))
+                    if not block:
+                        break
+                    remaining -= len(block)
+                    yield block
+            finally:
+                connection.close()
+        finally:
+            # the server may answer the end of the transfer or its abort, or nothing
+            try:
+                ftp.close()
+            except (IOError, OSError, EOFError, ftplib.Error):
+                pass
+        return
+    response = _urlopen(urllib_request.Request(url, headers={"Range": "bytes=%d-%d" % (start, end - 1)}))
+    if response.getcode() != 206:
+        raise IOError("%s does not support range requests" % url)
+    while remaining > 0:
+        block = response.read(min(remaining, 1024 * 1024))
+        if not block:
+            break
+        remaining -= len(block)
+        yield block
+
+def _remote_size(url):
+    """Return the size of url when its server can send byte ranges of it, None otherwise.
+    """
+    url = _mirror_url(url)
+    try:
+        if urllib_parse.urlparse(url).scheme == "ftp":
+            ftp = _ftp_connect(url)
+            try:
+                return ftp.size(urllib_parse.urlparse(url).path)
+            finally:
+                ftp.close()
+        request = urllib_request.Request(url)
+        request.get_method = lambda: "HEAD"
+        headers = _urlopen(request).info()
+        if headers.get("Accept-Ranges") == "bytes" and headers.get("Content-Length"):
+            return int(headers.get("Content-Length"))
+    except Exception:
+        pass
+    return None
+
+def _ftp_connect(url):
+    parsed = urllib_parse.urlparse(url)
+    ftp = ftplib.FTP()
+    ftp.connect(parsed.hostname, parsed.port or 21, timeout=60)
+    ftp.login(parsed.username or "anonymous", parsed.password or "anonymous@")
+    ftp.voidcmd("TYPE I")
+    return ftp
+
+def _urlopen(request):
+    try:
+        import ssl
+        # like wget --no-check-certificate
+        return urllib_request.urlopen(request, timeout=60, context=ssl._create_unverified_context())
+    except (ImportError, AttributeError, TypeError):
+        return urllib_request.urlopen(request, timeout=60)
+
+def _host_connections(url):
+    """Return the number of connections a download from the host of url may use.
+    """
+    for entry in str(env.host_connections or "").split(";"):
+        host, _, connections = entry.strip().rpartition(":")
+        if host and host == urllib_parse.urlparse(url).hostname:
+            return int(connections)
+    return int(env.download_connections)
+
+def _fetch_small_files(urls):
+    """Return the content of each of urls, fetched at the same time by as many threads as
+    connections allowed to their host, each thread keeping its connection open for its
+    next files.
+    """
+    local = threading.local()
+    def fetch(url):
+        mirror_url = _mirror_url(url)
+        parsed = urllib_parse.urlparse(mirror_url)
+        if parsed.scheme != "http":
+            content = _urlopen(urllib_request.Request(mirror_url)).read()
+        else:
+            if not hasattr(local, "connections"):
+                local.connections = {}
+            connections = local.connections
+            path = parsed.path + ("?%s" % parsed.query if parsed.query else "")
+            for attempt in range(int(env.download_retries)):
+                if parsed.netloc not in connections:
+                    connections[parsed.netloc] = http_client.HTTPConnection(parsed.netloc, timeout=60)
+                connection = connections[parsed.netloc]
+                try:
+                    connection.request("GET", path)
+                    response = connection.getresponse()
+                    content = response.read()
+                    break
+                except (IOError, OSError, http_client.HTTPException) as e:
+                    # closed by the server, connect again
+                    connection.close()
+                    del connections[parsed.netloc]
+                    warn("Download of %s failed: %s" % (url, e))
+            else:
+                raise IOError("%s not downloaded after %s attempts" % (url, env.download_retries))
+            if response.status != 200:
+                raise IOError("%s: HTTP %d %s" % (url, response.status, response.reason))
+        with _trace_lock:
+            _trace_downloaded[0] += len(content)
+        return content
+    pool = multiprocessing.pool.ThreadPool(min(len(urls), _host_connections(urls[0])) or 1)
+    try:
+        return pool.map(fetch, urls)
+    finally:
+        pool.close()
+        pool.join()
+
+def _mirror_url(url):
+    """Return the url url is downloaded from, on env.mirror when set.
+    Downloads are cached under their original url.
+    """
+    if not env.mirror:
+        return url
+    return "%s/%s" % (env.mirror.rstrip("/"), url.split("://", 1)[1])
+
+def _copy_blocks(source, sinks):
+    """Write every block read from source to sinks and return the sha256 of source.
+    """
+    digest = hashlib.sha256()
+    for block in iter(lambda: source.read(1024 * 1024), b''):
+        digest.update(block)
+        for sink in sinks:
+            sink.write(block)
+    return digest.hexdigest()
+
+def _tmp_name(path):
+    """Return a temporary name for path unique to this process and thread.
+    """
+    return "%s.%d.%d.part" % (path, os.getpid(), threading.current_thread().ident)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _link_or_copy(src, dest):
+    """Hard link src to dest, or copy it when they are on different file systems.
+    Files are hard linked rather than symlinked so they stay when evicted from the cache.
+    """
+    _remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        lrun("cp %s %s.part" % (src, dest))
+        os.rename("%s.part" % dest, dest)
+
+# ================================================================================
+# == Build artifact cache
+#
+# Compiled steps are stored once in env.cache_dir/artifacts, next to the downloads:
+# - <key>.tar.gz: the files installed by the step, relative to the project directory
+# - <key>.json: the manifest, written last, giving the project directory the step was
+#   built in and the files holding it: text files, binaries and symbolic links
+# Unpacked in another project directory, the old project directory is replaced in text
+# files and symbolic links, and in the strings of binaries, padded with null bytes, which
+# is only possible when the new project directory is not longer than the old one.
+
+def _artifact_path(*parts):
+    return os.path.join(env.cache_dir, "artifacts", *parts)
+
+def _artifact_key(step, code, args, inputs):
+    record = {"step": step,
+              "code": code,
+              "args": args,
+              "inputs": dict((name, value() if callable(value) else value) for name, value in inputs.items()),
+              "compiler": _compiler_version(),
+              "arch": platform.machine(),
+              "libc": platform.libc_ver()}
+    return "%s-%s" % (step, _sha256(json.dumps(record, sort_keys=True)))
+
+def _compiler_version():
+    try:
+        cc = subprocess.Popen(["cc", "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError:
+        return None
+    return cc.communicate()[0].decode("utf-8", "replace").split("\n")[0]
+
+def _unpack_artifact(step, key, dest=None):
+    """Unpack the artifact key into dest, the project directory by default, and relocate it
+    to the project directory, return False when there is no artifact for key or when it cannot
+    be relocated here.
+    """
+    dest = dest or env.project_dir
+    manifest_file = _artifact_path("%s.json" % key)
+    if not lexists(manifest_file):
+        return False
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    old_prefix = manifest["prefix"]
+    if "binary" in manifest["files"].values() and len(env.project_dir) > len(old_prefix):
+        puts("Building %s, its artifact built in %s cannot be relocated to the longer %s"
+             % (step, old_prefix, env.project_dir))
+        return False
+    puts("Installing %s from artifact %s" % (step, key))
+    _make_dir(dest)
+    lrun("tar -xzpf %s -C %s" % (_artifact_path("%s.tar.gz" % key), dest))
+    if old_prefix != env.project_dir:
+        for name, kind in manifest["files"].items():
+            _relocate(os.path.join(dest, name), kind, old_prefix, env.project_dir)
+    os.utime(manifest_file, None)
+    return True
+
+def _pack_artifact(step, key, root):
+    """Pack the files installed by step in root, its staging copy of the project directory,
+    into the artifact key.
+    """
+    prefix = env.project_dir.encode("utf-8")
+    files = {}
+    for dir_path, dir_names, file_names in os.walk(root):
+        for name in dir_names + file_names:
+            path = os.path.join(dir_path, name)
+            if os.path.islink(path):
+                if os.readlink(path).encode("utf-8").startswith(prefix):
+                    files[os.path.relpath(path, root)] = "link"
+            elif os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if prefix in data:
+                    files[os.path.relpath(path, root)] = "binary" if b"\0" in data else "text"
+    _make_dir(_artifact_path())
+    archive = _artifact_path("%s.tar.gz" % key)
+    lrun("tar -czf %s -C %s ." % (_tmp_name(archive), root))
+    os.rename(_tmp_name(archive), archive)
+    manifest_file = _artifact_path("%s.json" % key)
+    with open(_tmp_name(manifest_file), 'w') as f:
+        json.dump({"step": step, "prefix": env.project_dir, "files": files,
+                   "host": platform.node(), "built": time.strftime("%Y-%m-%d %H:%M:%S")},
+                  f, indent=1, sort_keys=True)
+    os.rename(_tmp_name(manifest_file), manifest_file)
+    puts("Stored %s in artifact %s" % (step, key))
+
+def _relocate(path, kind, old_prefix, new_prefix):
+    """Replace old_prefix by new_prefix in path, a text file, binary or symbolic link.
+    """
+    if kind == "link":
+        target = os.readlink(path)
+        os.remove(path)
+        os.symlink(new_prefix + target[len(old_prefix):], path)
+        return
+    old, new = old_prefix.encode("utf-8"), new_prefix.encode("utf-8")
+    with open(path, 'rb') as f:
+        data = f.read()
+    if kind == "text":
+        data = data.replace(old, new)
+    else:
+        # keep the length of the strings holding old_prefix, and of the binary
+        def padded(match):
+            string = new + match.group(1).replace(old, new)
+            return string + b"\0" * (len(match.group(0)) - len(string))
+        data = re.sub(re.escape(old) + b"([^\0]*)\0", padded, data)
+    with open(_tmp_name(path), 'wb') as f:
+        f.write(data)
+    shutil.copymode(path, _tmp_name(path))
+    os.rename(_tmp_name(path), path)
+
+# ================================================================================
+# == Versioned installs
+#
+# Compiled steps are installed side by side in versions/ of the project directory:
+# - <step>-<key>/: the files installed by one version of the step, relative to the project
+#   directory, built or relocated for the paths of the project directory
+# - sets/<n>/: a symbolic link <step> to the version of each step, and manifest.json
+# - current: a symbolic link to the active set
+# Each file installed by a step is a symbolic link in the project directory, bin/bwa to
+# versions/current/install_bwa/bin/bwa, so the paths written in config.ini and env.sh do
+# not change. Switching to a new set renames one symbolic link over current, switching
+# every file of every step at once: programs started after the switch use the new versions
+# and running jobs keep the files of the old ones, which stay until prune_versions.
+
+def _versions_path(*parts):
+    return os.path.join(env.project_dir, "versions", *parts)
+
+def _version_dir(key):
+    """Return the version directory of the artifact key, <step>-<key>.
+    """
+    step, _, digest = key.rpartition("-")
+    return _versions_path("%s-%s" % (step, digest[:12]))
+
+def _version_files(version_dir):
+    """Return the files and symbolic links of version_dir, relative to it.
+    """
+    files = []
+    for dir_path, dir_names, file_names in os.walk(version_dir):
+        for name in dir_names + file_names:
+            path = os.path.join(dir_path, name)
+            if name in file_names or os.path.islink(path):
+                files.append(os.path.relpath(path, version_dir))
+    return files
+
+def _symlink(target, path):
+    """Point path to target, replacing what path was in one rename.
+    """
+    if os.path.islink(path) and os.readlink(path) == target:
+        return
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    _remove(_tmp_name(path))
+    os.symlink(target, _tmp_name(path))
+    os.rename(_tmp_name(path), path)
+
+@contextmanager
+def _versions_lock():
+    """Hold the lock of versions/ against the steps of deploy_parallel switching at the same time.
+    """
+    _make_dir(_versions_path())
+    with open(_versions_path(".lock"), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def _active_versions():
+    """Return the manifest of the active set, {} when nothing was installed in versions/.
+    """
+    manifest_file = _versions_path("current", "manifest.json")
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def _version_sets():
+    sets_dir = _versions_path("sets")
+    return sorted(int(name) for name in os.listdir(sets_dir) if name.isdigit()) if lexists(sets_dir) else []
+
+def _pending_versions():
+    """Return the versions installed since the last switch, {step: version directory}.
+    """
+    pending_file = _versions_path("pending.json")
+    if not os.path.exists(pending_file):
+        return {}
+    with open(pending_file) as f:
+        return json.load(f)
+
+def _install_version(step, version_dir):
+    """Move the version of step built or unpacked in the temporary name of version_dir
+    to version_dir, to be switched to with the other versions installed by the deploy,
+    see _deferred_version_switch. Its files not installed yet are linked for the next steps,
+    the others stay in their active version until the switch.
+    """
+    with _versions_lock():
+        if lexists(_tmp_name(version_dir)):
+            if lexists(version_dir):
+                lrun("rm -rf %s" % _tmp_name(version_dir))
+            else:
+                os.rename(_tmp_name(version_dir), version_dir)
+        for name in _version_files(version_dir):
+            if not os.path.lexists(os.path.join(env.project_dir, name)):
+                _symlink(os.path.join(version_dir, name), os.path.join(env.project_dir, name))
+        pending = dict(_pending_versions(), **{step: os.path.basename(version_dir)})
+        with open(_tmp_name(_versions_path("pending.json")), 'w') as f:
+            json.dump(pending, f, indent=1, sort_keys=True)
+        os.rename(_tmp_name(_versions_path("pending.json")), _versions_path("pending.json"))
+
+# tasks and steps running in this process, or in the deploy_parallel process that started it
+_version_switch_depth = [0]
+
+@contextmanager
+def _deferred_version_switch():
+    """Switch to the versions installed by the block in one set when it completes, unless
+    it runs within another task or step, so that a deploy never makes a set mixing old
+    and new versions. Nothing is switched when the block fails; the versions it installed
+    are switched to at the end of the next deploy.
+    """
+    _version_switch_depth[0] += 1
+    try:
+        yield
+    finally:
+        _version_switch_depth[0] -= 1
+    if not _version_switch_depth[0] and lexists(_versions_path("pending.json")):
+        with _versions_lock():
+            pending = _pending_versions()
+            _switch_versions(dict(_active_versions().get("components", {}), **pending))
+            _remove(_versions_path("pending.json"))
+
+def _switch_versions(components):
+    """Make components, {step: version directory}, the active set. Called holding _versions_lock.
+    The files of the new versions are linked through versions/current before current is
+    switched, and the links to files the new versions no longer have are removed after.
+    """
+    active = _active_versions()
+    old_components = active.get("components", {})
+    for step, name in components.items():
+        for file_name in _version_files(_versions_path(name)):
+            _symlink(_versions_path("current", step, file_name), os.path.join(env.project_dir, file_name))
+    if components == old_components:
+        return
+    set_id = str(max(_version_sets() + [0]) + 1)
+    set_dir = _versions_path("sets", set_id)
+    os.makedirs(set_dir)
+    for step, name in components.items():
+        os.symlink(os.path.join("..", "..", name), os.path.join(set_dir, step))
+    with open(os.path.join(set_dir, "manifest.json"), 'w') as f:
+        json.dump({"set": set_id, "previous": active.get("set"), "components": components,
+                   "switched": time.strftime("%Y-%m-%d %H:%M:%S")}, f, indent=1, sort_keys=True)
+    _symlink(os.path.join("sets", set_id), _versions_path("current"))
+    for step, name in old_components.items():
+        if components.get(step) == name:
+            continue
+        stale = set(_version_files(_versions_path(name)))
+        if step in components:
+            stale -= set(_version_files(_versions_path(components[step])))
+        for file_name in stale:
+            path = os.path.join(env.project_dir, file_name)
+            if os.path.islink(path) and os.readlink(path) == _versions_path("current", step, file_name):
+                os.remove(path)
+                try:
+                    os.removedirs(os.path.dirname(path))
+                except OSError:
+                    pass # not empty
+    puts("Switched to versions set %s: %s" % (set_id, ", ".join(
+        "%s %s" % (step, name) for step, name in sorted(components.items()) if old_components.get(step) != name)))
+
+# ================================================================================
+# == Installed environment probe
+#
+# What is installed is found by starting each interpreter once and asking it for all its
+# libraries and their versions, and by listing bin/, rather than one shell per check.
+# The probe of each section is done when a step first needs it, kept until a step has
+# run, and written to installed.json in the project directory.
+
+_probe_cache = {}
+
+def _installed(section):
+    """Return what is installed for section of PROBES, as a dictionary of name to version.
+    """
+    if section not in _probe_cache:
+        _probe_cache[section] = PROBES[section]()
+        _write_manifest()
+    return _probe_cache[section]
+
+def _manifest_file():
+    return os.path.join(env.project_dir, "installed.json")
+
+def _write_manifest():
+    manifest = {}
+    if lexists(_manifest_file()):
+        with open(_manifest_file()) as f:
+            manifest = json.load(f)
+    manifest.update(_probe_cache)
+    manifest["probed"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    with open(_tmp_name(_manifest_file()), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(_tmp_name(_manifest_file()), _manifest_file())
+
+def _probe(command):
+    """Return the output lines of command run in the virtual environment, none when it fails.
+    """
+    with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
+        result = vlrun(command, capture=True)
+    if result.failed:
+        return []
+    return result.splitlines()
+
+def _probe_python():
+    # on one line, csh does not pass a newline within quotes to the command
+    lines = _probe("""python -c 'import pkg_resources; print("\\n".join("%s %s" % (d.project_name.lower(), d.version) for d in pkg_resources.working_set))'""")
+    return dict(line.split()[:2] for line in lines if len(line.split()) >= 2)
+
+def _probe_r():
+    rscript = os.path.join(env.bin_dir, "Rscript")
+    if not lexists(rscript):
+        return {}
+    lines = _probe("""%s -e 'ip <- installed.packages(lib.loc=c("%s", .Library)); write.table(ip[, c("Package", "Version")], quote=FALSE, row.names=FALSE, col.names=FALSE)'"""
+                   % (rscript, env.r_lib_dir))
+    return dict(line.split()[:2] for line in lines if len(line.split()) >= 2)
+
+def _probe_perl():
+    perl = os.path.join(env.perl_dir, "bin", "perl")
+    if not lexists(perl):
+        return {}
+    modules = ["App::cpanminus"] + PERL_LIBRARIES
+    lines = _probe("""%s -e 'for $m (@ARGV) { (my $f = "$m.pm") =~ s{::}{/}g; print "$m ", $m->VERSION || 0, "\\n" if eval { require $f } }' %s"""
+                   % (perl, " ".join(modules)))
+    return dict(line.split()[:2] for line in lines if len(line.split()) >= 2)
+
+def _probe_bin():
+    installed = {}
+    if lexists(env.bin_dir):
+        for name in os.listdir(env.bin_dir):
+            path = os.path.join(env.bin_dir, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                installed[name] = None
+    return installed
+
+# Probes run by _installed, by section of installed.json
+PROBES = {"python": _probe_python,
+          "R": _probe_r,
+          "perl": _probe_perl,
+          "bin": _probe_bin}
+
 # ================================================================================
 # == Required dependencies to install chipseq pipeline
 
+@_traced("task")
 def install_dependencies():
     """Install chipseq dependencies:
     - tar
@@ -224,67 +1906,129 @@ def install_dependencies():
     install_java()
     install_workflow()
     
-def install_tar():
+@_stamped()
+@_artifact()
+def install_tar(xz_url="http://tukaani.org/xz/xz-5.0.5.tar.gz",
+                url="http://ftp.gnu.org/gnu/tar/tar-1.27.tar.gz"):
     """Install tar 1.27 with xz 5.0.5
     to uncompress xz archive
     """
-    xz_url = "http://tukaani.org/xz/xz-5.0.5.tar.gz"
-    url = "http://ftp.gnu.org/gnu/tar/tar-1.27.tar.gz"
     _get_install(xz_url, env, _configure_make)
     _get_install(url, env, _configure_make)
 
-def install_atlas():
+@_stamped()
+@_artifact()
+def install_atlas(lapack_url="http://www.netlib.org/lapack/lapack-3.4.1.tgz",
+                  atlas_url="http://sourceforge.net/projects/math-atlas/files/Stable/3.10.1/atlas3.10.1.tar.bz2",
+                  options="-b 64 -D c -DPentiumCPS=2400 --shared"):
     """Install atlas 3.10.1
     Atlas may need to be installed to have numpy anc scipy installed
     """
-    lapack_url = "http://www.netlib.org/lapack/lapack-3.4.1.tgz"
-    lapack_tar = os.path.join(env.tmp_dir, 'lapack-3.4.1.tgz')
-    atlas_url = "http://sourceforge.net/projects/math-atlas/files/Stable/3.10.1/atlas3.10.1.tar.bz2"
     atlas_dir = "ATLAS3.10.1"
     atlas_lib = os.path.join(env.lib_dir, 'atlas')
     _make_dir(atlas_lib)
     with lcd(env.tmp_dir):
-        lrun("wget %s" % lapack_url)
+        lapack_tar = _fetch_cached(lapack_url)
         dir_name = _fetch_and_unpack(env.tmp_dir, atlas_url)
-        lrun("mv ATLAS %s" % atlas_dir)
+        lrun("rm -rf %s && mv %s %s" % (atlas_dir, dir_name, atlas_dir))
         with lcd(atlas_dir):
             _make_dir("linux_install")
             with lcd("linux_install"):
-                lrun("../configure -b 64 -D c -DPentiumCPS=2400 --shared --prefix=%s --with-netlib-lapack-tarfile=%s" % (atlas_lib, lapack_tar))
-                lrun("make build")
-                lrun("make check")
-                lrun("make ptcheck")
-                lrun("make install")
-    with lcd(env.lib_dir):
+                lrun("../configure %s --prefix=%s --with-netlib-lapack-tarfile=%s" % (options, atlas_lib, lapack_tar))
+                # ATLAS tunes itself with timings and does not support a parallel make
+                lrun(_make("build", parallel=False))
+                lrun(_make("check", parallel=False))
+                lrun(_make("ptcheck", parallel=False))
+                # DESTDIR of ATLAS is its install prefix, written by configure in Make.inc
+                lrun(_make("install DESTDIR=%s" % _staged(atlas_lib), parallel=False))
+    with lcd(_staged(env.lib_dir)):
         # all shared lib needs to be moved from lib/atlas/lib to lib/atlas to be picked up by scipy installer
         lrun("mv atlas/lib/* atlas/.")
         
-def install_cairo():
+@_stamped()
+@_artifact()
+def install_cairo(pixman_url="http://www.cairographics.org/releases/pixman-0.30.2.tar.gz",
+                  cairo_url="http://www.cairographics.org/releases/cairo-1.12.16.tar.xz",
+                  options="--disable-static --disable-gobject"):
     """Install cairo 1.12.16
     Needed when no X11 support available
     """ 
-    pixman_url = "http://www.cairographics.org/releases/pixman-0.30.2.tar.gz"
-    cairo_url = "http://www.cairographics.org/releases/cairo-1.12.16.tar.xz"
     _get_install(pixman_url, env, _configure_make)
-    _get_install(cairo_url, env, _configure_make, "--disable-static --disable-gobject")
-    
+    _get_install(cairo_url, env, _configure_make, options)
+
+# Python libraries installed in order by install_python_libraries
+PYTHON_LIBRARIES = [
+    "fluent-logger==0.3.3",
+    "nose==1.3.0",
+    "numpy==1.7.1",
+    "cython==0.19.2",
+    "numexpr==2.2.2",
+    "pyyaml==3.10",
+    "rpy2==2.3.8",
+    "pysam==0.7.4",
+    "scipy==0.12.1",
+    "bx-python==0.7.1",
+    "configparser",
+    "biopython==1.62",
+]
+
+# Python modules imported by the pipeline jobs, timed by report_load_times
+PYTHON_MODULES = ["numpy", "scipy", "pysam", "bx", "Bio", "rpy", "rpy2.robjects", "yaml", "MACS14"]
+
+@_stamped(libraries=PYTHON_LIBRARIES)
 def install_python_libraries():
     """Install Python libraries
+    Wheels of the libraries are built once in the wheelhouse of env.cache_dir and installed
+    from there with a single pip command, without network access.
     """
-    vlrun("pip install fluent-logger==0.3.3")
-    vlrun("pip install nose==1.3.0")
-    vlrun("pip install numpy==1.7.1")
-    vlrun("pip install cython==0.19.2")
-    vlrun("pip install numexpr==2.2.2")
-    vlrun("pip install pyyaml==3.10")
-    vlrun("pip install rpy2==2.3.8")
-    vlrun("pip install pysam==0.7.4")
-    vlrun("pip install scipy==0.12.1")
-    vlrun("pip install bx-python==0.7.1")
-    vlrun("pip install configparser")
-    vlrun("pip install biopython==1.62")    
+    installed = _installed("python")
+    missing = []
+    for library in PYTHON_LIBRARIES:
+        name, version = _python_requirement(library)
+        if name.lower() not in installed or version not in (None, installed[name.lower()]):
+            missing.append(library)
+    if missing and _as_bool(env.wheels):
+        _install_wheels(missing)
+    else:
+        for library in missing:
+            vlrun("pip install %s" % library)
     _install_rpy_lib()
 
+def _python_requirement(library):
+    """Return (name, version) of a library of PYTHON_LIBRARIES, version None when not pinned.
+    """
+    return tuple((library.split("==") + [None])[:2])
+
+def _install_wheels(libraries):
+    """Install libraries from the wheelhouse, building the wheels missing from it first.
+    """
+    wheelhouse = _wheelhouse_dir()
+    _make_dir(wheelhouse)
+    unbuilt = [library for library in libraries if not _find_wheel(wheelhouse, library)]
+    if unbuilt:
+        vlrun("pip install wheel")
+        build_dir = os.path.join(env.tmp_dir, "wheels")
+        for library in unbuilt:
+            lrun("rm -rf %s" % build_dir)
+            vlrun("pip wheel --wheel-dir=%s --find-links=%s %s" % (build_dir, wheelhouse, library))
+            # wheels are copied under a temporary name so that the wheelhouse never holds partial files
+            for wheel in os.listdir(build_dir):
+                if not lexists(os.path.join(wheelhouse, wheel)):
+                    _link_or_copy(os.path.join(build_dir, wheel), os.path.join(wheelhouse, wheel))
+            # libraries built later need the ones before them, e.g. scipy needs numpy
+            vlrun("pip install --no-index --find-links=%s %s" % (wheelhouse, library))
+        lrun("rm -rf %s" % build_dir)
+    vlrun("pip install --no-index --find-links=%s %s" % (wheelhouse, " ".join(libraries)))
+
+def _wheelhouse_dir():
+    # wheels are tagged with the python version but not with the C library they link to
+    return os.path.join(env.cache_dir, "wheelhouse", "%s-%s" % (platform.machine(), "".join(platform.libc_ver())))
+
+def _find_wheel(wheelhouse, library):
+    name, version = _python_requirement(library)
+    prefix = "%s-%s" % (name.replace("-", "_").lower(), "%s-" % version if version else "")
+    return [wheel for wheel in os.listdir(wheelhouse) if wheel.lower().startswith(prefix) and wheel.endswith(".whl")]
+
 @_if_not_python_lib("rpy")
 def _install_rpy_lib():
     """Install RPy 1.0.3
@@ -297,165 +2041,222 @@ def _install_rpy_lib():
             lrun("sed -i 's/Rdevices.h/Rembedded.h/g' src/RPy.h")
             vlrun("python setup.py install")
 
-def install_r():
+@_stamped()
+@_artifact()
+def install_r(url="http://cran.r-project.org/src/base/R-2/R-2.15.0.tar.gz", options="--enable-R-shlib"):
     """Install R 2.15.0
     """
     _make_dir(env.r_lib_dir)
-    url = "http://cran.r-project.org/src/base/R-2/R-2.15.0.tar.gz"
-    option = "--enable-R-shlib"
-    if not lexists(os.path.join(env.r_dir, "bin/R")):
-        _get_install(url, env, _configure_make, option)
-        # create symlinks in bin for installation on mac only
-        if not lexists(os.path.join(env.bin_dir, "R")):
-            lrun('ln -fs %(r_dir)s/bin/R %(bin_dir)s/R' % env)
-            lrun('ln -fs %(r_dir)s/bin/Rscript %(bin_dir)s/Rscript' % env)
+    _get_install(url, env, _configure_make, options)
+    # create symlinks in bin for installation on mac only
+    if not os.path.lexists(os.path.join(_staged(env.bin_dir), "R")):
+        lrun('ln -fs %s/bin/R %s/R' % (env.r_dir, _staged(env.bin_dir)))
+        lrun('ln -fs %s/bin/Rscript %s/Rscript' % (env.r_dir, _staged(env.bin_dir)))
 
+@_stamped(libraries=lambda: _sha256_file(os.path.join(env.chipseq_installer, "scripts/r-libraries.yaml")))
 def install_r_libraries():
     """Install R libraries listed in r-libraries.yaml needed to run chipseq pipeline
+    Libraries already installed, or installed at the pinned version for archives, are skipped.
     """
     # Load list of R libraries to install
     config_file = open(os.path.join(env.chipseq_installer, "scripts/r-libraries.yaml"), 'r')
     config = yaml.load(config_file)
-    # Create an Rscript file with install details.
-    out_file = "install_packages.R"
-    if lexists(out_file):
-        lrun("rm -f %s" % out_file)
-    lrun("touch %s" % out_file)
-    repo_info = """
-    cran.repos <- getOption(\"repos\")
-    cran.repos[\"CRAN\" ] <- \"%s\"
-    options(repos=cran.repos)
-    source(\"%s\")
-    """ % (config["cranrepo"], config["biocrepo"])
-    lrun("echo '%s' >> %s" % (repo_info, out_file))
-    bioc_install = """
-    bioc.pkgs <- c(%s)
-
-    """ % (", ".join('"%s"' % p for p in config['bioc']))
-    bioc_install2 = """
-    biocLite(lib=\"%(r_lib_dir)s\",lib.loc=\"%(r_lib_dir)s\",ask=F)
-    biocLite(bioc.pkgs,lib=\"%(r_lib_dir)s\",lib.loc=\"%(r_lib_dir)s\",ask=F)    
-    """ % env
-    lrun("echo '%s' >> %s" % (bioc_install, out_file))
-    lrun("echo '%s' >> %s" % (bioc_install2, out_file))
-    std_install = """
-    std.pkgs <- c(%s)
-    """ % (", ".join('"%s"' % p for p in config['cran']))
-    lrun("echo '%s' >> %s" % (std_install, out_file))
-    std_install2 = """
-    install.packages(std.pkgs,lib=\"%(r_lib_dir)s\")
-    """ % env
-    lrun("echo '%s' >> %s" % (std_install2, out_file))
-    gplots_install = """
-    download.file(\"http://cran.r-project.org/src/contrib/Archive/gplots/gplots_2.10.1.tar.gz\",\"%(tmp_dir)s/gplots_2.10.1.tar.gz\")
-    
-    """ % env
-    lrun("echo '%s' >> %s" % (gplots_install, out_file))
-    gplots_install2 = """
-    install.packages(\"%(tmp_dir)s/gplots_2.10.1.tar.gz\",lib=\"%(r_lib_dir)s\")
-    """ % env
-    lrun("echo '%s' >> %s" % (gplots_install2, out_file))    
-    
-    spp_install = """
-    download.file(\"http://compbio.med.harvard.edu/Supplements/ChIP-seq/spp_1.11.tar.gz\",\"%(tmp_dir)s/spp_1.11.tar.gz\")
-    
-    """ % env
-    lrun("echo '%s' >> %s" % (spp_install, out_file))
-    spp_install2 = """
-    install.packages(\"%(tmp_dir)s/spp_1.11.tar.gz\",lib=\"%(r_lib_dir)s\")
-    
-    """ % env
-    lrun("echo '%s' >> %s" % (spp_install2, out_file))  
-    GMC_install = """
-    download.file(\"http://genometricorr.sourceforge.net/R/src/contrib/GenometriCorr_1.1.9.tar.gz\",\"%(tmp_dir)s/GenometriCorr_1.1.9.tar.gz\")
-    
-    """ % env
-    lrun("echo '%s' >> %s" % (GMC_install, out_file))
-    GMC_install2 = """
-    install.packages(\"%(tmp_dir)s/GenometriCorr_1.1.9.tar.gz\",lib=\"%(r_lib_dir)s\")
-    
-    """ % env
-    lrun("echo '%s' >> %s" % (GMC_install2, out_file))       
-
-    hmisc_install = """
-    download.file(\"http://cran.r-project.org/src/contrib/Archive/Hmisc/Hmisc_3.10-1.1.tar.gz\",\"%(tmp_dir)s/Hmisc_3.10-1.1.tar.gz\")   
-    """ % env
-    lrun("echo '%s' >> %s" % (hmisc_install, out_file))
-    hmisc_install2 = """
-    install.packages(\"%(tmp_dir)s/Hmisc_3.10-1.1.tar.gz\",lib=\"%(r_lib_dir)s\")
-    """ % env
-    lrun("echo '%s' >> %s" % (hmisc_install2, out_file))       
-
-    gdd_install = """
-    download.file(\"http://www.rforge.net/src/contrib/GDD_0.1-13.tar.gz\",\"%(tmp_dir)s/GDD_0.1-13.tar.gz\")   
-    """ % env
-    lrun("echo '%s' >> %s" % (gdd_install, out_file))
-    gdd_install2 = """
-    install.packages(\"%(tmp_dir)s/GDD_0.1-13.tar.gz\",lib=\"%(r_lib_dir)s\")
-    """ % env
-    lrun("echo '%s' >> %s" % (gdd_install2, out_file))       
-       
-    gridsvg_install = """
-    download.file(\"http://cran.r-project.org/src/contrib/Archive/gridSVG/gridSVG_0.9-1.tar.gz\",\"%(tmp_dir)s/gridSVG_0.9-1.tar.gz\")   
-    """ % env
-    lrun("echo '%s' >> %s" % (gridsvg_install, out_file))
-    gridsvg_install2 = """
-    install.packages(\"%(tmp_dir)s/gridSVG_0.9-1.tar.gz\",lib=\"%(r_lib_dir)s\")
-    """ % env
-    lrun("echo '%s' >> %s" % (gridsvg_install2, out_file))       
-
+    installed = _installed("R")
+    bioc = [p for p in config['bioc'] if p not in installed]
+    cran = [p for p in config['cran'] if p not in installed]
+    archives = [a for a in config['archives'] if installed.get(a['name']) != str(a['version'])]
+    if not (bioc or cran or archives):
+        puts("All R libraries are installed")
+        return
+    _install_r_packages(config, bioc, cran, archives)
+
+def _install_r_packages(config, bioc, cran, archives):
+    """Install the bioc and cran packages, and archives, the pinned entries of r-libraries.yaml,
+    byte-compiled.
+    """
+    # Fetch the pinned archives at the same time
+    _run_pool(_fetch, [(env.tmp_dir, a['url']) for a in archives], env.download_jobs)
+    # Create an Rscript file with install details, installing up to env.make_jobs packages
+    # at a time in dependency order, and archives last in the order they are listed.
+    script = ['cran.repos <- getOption("repos")',
+              'cran.repos["CRAN"] <- "%s"' % config["cranrepo"],
+              'options(repos=cran.repos)']
+    if bioc:
+        script.extend(['source("%s")' % config["biocrepo"],
+                       'biocLite(lib="%(r_lib_dir)s", lib.loc="%(r_lib_dir)s", ask=F)' % env,
+                       'biocLite(c(%s), lib="%s", lib.loc="%s", ask=F, Ncpus=%s, INSTALL_opts="--byte-compile")'
+                       % (_r_strings(bioc), env.r_lib_dir, env.r_lib_dir, env.make_jobs)])
+    if cran:
+        script.append('install.packages(c(%s), lib="%s", Ncpus=%s, INSTALL_opts="--byte-compile")'
+                      % (_r_strings(cran), env.r_lib_dir, env.make_jobs))
+    if archives:
+        archive_files = [os.path.join(env.tmp_dir, os.path.split(a['url'])[-1]) for a in archives]
+        script.append('install.packages(c(%s), lib="%s", repos=NULL, type="source", INSTALL_opts="--byte-compile")'
+                      % (_r_strings(archive_files), env.r_lib_dir))
+    out_file = os.path.join(env.tmp_dir, "install_packages.R")
+    with open(out_file, 'w') as f:
+        f.write("\n".join(script) + "\n")
     # Run the script and then get rid of it
     vlrun("%s %s" % (os.path.join(env.bin_dir, "Rscript"), out_file))
     lrun("rm -f %s" % out_file)
 
-def install_perl():
+def _r_strings(values):
+    return ", ".join('"%s"' % value for value in values)
+
+@_stamped()
+def compile_libraries():
+    """Byte-compile the installed R packages and python modules, for faster job startup
+    R packages installed without byte code are installed again with --byte-compile, and
+    the .pyc files missing or older than their module are written next to them, so that
+    jobs do not compile them on every start when the project directory is read-only.
+    Run report_load_times to see the time each library takes to load.
+    """
+    _compile_r_libraries()
+    _compile_python_libraries()
+
+def _compile_r_libraries():
+    rscript = os.path.join(env.bin_dir, "Rscript")
+    if not lexists(rscript):
+        return
+    # a package is byte-compiled when its first function prints with its <bytecode>
+    script = ['lib <- "%s"' % env.r_lib_dir,
+              'is.compiled <- function(p) {',
+              '  ns <- tryCatch(suppressMessages(loadNamespace(p, lib.loc=lib)), error=function(e) NULL)',
+              '  for (name in if (is.null(ns)) character(0) else ls(ns, all.names=TRUE)) {',
+              '    f <- get(name, envir=ns)',
+              '    if (is.function(f) && !is.primitive(f))',
+              '      return(any(grepl("<bytecode", capture.output(print(f)), fixed=TRUE)))',
+              '  }',
+              '  TRUE',
+              '}',
+              'for (p in rownames(installed.packages(lib.loc=lib))) if (!is.compiled(p)) cat("uncompiled", p, "\\n")']
+    out_file = os.path.join(env.tmp_dir, "compiled_packages.R")
+    with open(out_file, 'w') as f:
+        f.write("\n".join(script) + "\n")
+    uncompiled = [line.split()[1] for line in _probe("%s %s" % (rscript, out_file)) if line.startswith("uncompiled ")]
+    lrun("rm -f %s" % out_file)
+    if not uncompiled:
+        puts("All R libraries are byte-compiled")
+        return
+    puts("Byte-compiling R libraries %s" % ", ".join(uncompiled))
+    with open(os.path.join(env.chipseq_installer, "scripts/r-libraries.yaml")) as config_file:
+        config = yaml.load(config_file)
+    archives = [a for a in config['archives'] if a['name'] in uncompiled]
+    _install_r_packages(config, [p for p in uncompiled if p not in [a['name'] for a in archives]], [], archives)
+
+def _compile_python_libraries():
+    # python 2 modules of other packages, e.g. their python 3 tests, do not compile
+    with settings(warn_only=True):
+        for path in [os.path.join(env.lib_dir, "python2.7/site-packages"), env.sicer_dir]:
+            if lexists(path) and vlrun("python -m compileall -q %s" % path).failed:
+                warn("Some python modules of %s do not compile" % path)
+
+def report_load_times(repeat=3):
+    """Report the time each R package and python module of the pipeline takes to load
+    Each library is loaded in a new interpreter repeat times; the median time, less the
+    startup time of the interpreter, is reported and written to logs/load_times.json.
+    Usage:
+        fab -f scripts/chipseq_installer.py local report_load_times:repeat=5
+    """
+    with open(os.path.join(env.chipseq_installer, "scripts/r-libraries.yaml")) as config_file:
+        config = yaml.load(config_file)
+    rscript = os.path.join(env.bin_dir, "Rscript")
+    python = os.path.join(env.bin_dir, "python")
+    r_packages = [p for p in config['bioc'] + config['cran'] + [a['name'] for a in config['archives']]
+                  if p in _installed("R")]
+    loads = {"R": dict((p, [rscript, "-e", 'suppressPackageStartupMessages(library(%s, lib.loc="%s"))'
+                            % (p, env.r_lib_dir)]) for p in r_packages),
+             "python": dict((m, [python, "-c", "import %s" % m]) for m in PYTHON_MODULES)}
+    startup = {"R": _load_time([rscript, "-e", "0"], int(repeat)),
+               "python": _load_time([python, "-c", "pass"], int(repeat))}
+    report = {"startup": dict((language, wall and round(wall, 3)) for language, wall in startup.items()),
+              "R": {}, "python": {}}
+    for language, commands in sorted(loads.items()):
+        if startup[language] is None:
+            continue
+        for name, command in sorted(commands.items()):
+            wall = _load_time(command, int(repeat))
+            report[language][name] = wall and round(wall - startup[language], 3)
+    _make_dir(env.log_dir)
+    with open(os.path.join(env.log_dir, "load_times.json"), 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    for language in ("R", "python"):
+        if startup[language] is None:
+            continue
+        puts("%s starts in %.2fs, then loads:" % (language, startup[language]))
+        for name, wall in sorted(report[language].items(), key=lambda item: -(item[1] or 0)):
+            puts("  %-24s %s" % (name, "%.2fs" % wall if wall is not None else "failed"))
+    puts("Load times written to %s" % os.path.join(env.log_dir, "load_times.json"))
+
+def _load_time(command, repeat):
+    """Return the median wall time of command run repeat times, None when it fails.
+    """
+    if not lexists(command[0]):
+        return None
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            start = time.time()
+            if subprocess.call(command, stdout=devnull, stderr=devnull) != 0:
+                return None
+            times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+@_stamped()
+@_artifact()
+def install_perl(url="http://www.cpan.org/src/5.0/perl-5.18.0.tar.gz"):
     """Install perl 5.18.0
     """
-    url = "http://www.cpan.org/src/5.0/perl-5.18.0.tar.gz"
     with lcd(env.tmp_dir):
         dir_name = _fetch_and_unpack(env.tmp_dir, url)
         if not lexists(env.perl_dir):
             _make_dir(env.perl_dir)
         with lcd(dir_name):
             lrun("sh Configure -de -Dprefix='%s'" % (env.perl_dir))
-            lrun("make")
-            lrun("make install")
+            lrun(_make())
+            lrun(_make_install())
+
+# Perl libraries installed with cpanm by install_perl_libraries
+PERL_LIBRARIES = ["HTML::PullParser", "HTML::Template", "LWP", "SOAP::Lite", "XML::Simple"]
 
+@_stamped(libraries=PERL_LIBRARIES)
 def install_perl_libraries():
     """Install perl libraries
     """
-    lrun("%s/bin/cpan App::cpanminus < /dev/null" % (env.perl_dir))    
-    lrun("%s/bin/cpanm --skip-installed --notest HTML::PullParser < /dev/null" % (env.perl_dir))
-    lrun("%s/bin/cpanm --skip-installed --notest HTML::Template < /dev/null" % (env.perl_dir))
-    lrun("%s/bin/cpanm --skip-installed --notest LWP < /dev/null" % (env.perl_dir))
-    lrun("%s/bin/cpanm --skip-installed --notest SOAP::Lite < /dev/null" % (env.perl_dir))
-    lrun("%s/bin/cpanm --skip-installed --notest XML::Simple < /dev/null" % (env.perl_dir))    
+    installed = _installed("perl")
+    if "App::cpanminus" not in installed:
+        lrun("%s/bin/cpan App::cpanminus < /dev/null" % (env.perl_dir))
+    for library in PERL_LIBRARIES:
+        if library not in installed:
+            lrun("%s/bin/cpanm --skip-installed --notest %s < /dev/null" % (env.perl_dir, library))
                 
-def install_rsync():
+@_stamped()
+@_artifact()
+def install_rsync(url="http://rsync.samba.org/ftp/rsync/src/rsync-3.1.0.tar.gz"):
     """Install rsync 3.1.0
     """
-    url = "http://rsync.samba.org/ftp/rsync/src/rsync-3.1.0.tar.gz"
     _get_install(url, env, _configure_make)
     
-def install_git():
+@_stamped()
+@_artifact()
+def install_git(url="http://git-core.googlecode.com/files/git-1.8.4.2.tar.gz"):
     """Install git 1.8.4.2
     """
-    url = "http://git-core.googlecode.com/files/git-1.8.4.2.tar.gz"
     with lcd(env.tmp_dir):
         dir_name = _fetch_and_unpack(env.tmp_dir, url)
         with lcd(dir_name):
-            lrun("make prefix=%s all" % env.project_dir)
-            lrun("make prefix=%s install" % env.project_dir)
+            lrun(_make("prefix=%s all" % env.project_dir))
+            lrun("%s prefix=%s" % (_make_install(), env.project_dir))
 
-def install_java():
+@_stamped()
+def install_java(url="http://download.oracle.com/otn-pub/java/jdk/7u51-b13/jdk-7u51-linux-x64.tar.gz"):
     """Install Java 7
     http://download.oracle.com/otn-pub/java/jdk/7u51-b13/jdk-7u51-linux-x64.tar.gz
     """
-    tar_file = "jdk-7u51-linux-x64.tar.gz"
-    with lcd(env.tmp_dir):
-        lrun('wget --no-check-certificate --no-cookies --header "Cookie: oraclelicense=accept-securebackup-cookie" http://download.oracle.com/otn-pub/java/jdk/7u51-b13/%s -O %s' % (tar_file, tar_file))
-        lrun ("tar zxvf %s -C %s" % (tar_file, env.lib_dir))
+    tar_file = _fetch_cached(url, wget_options='--no-cookies --header "Cookie: oraclelicense=accept-securebackup-cookie"')
+    lrun ("tar zxvf %s -C %s" % (tar_file, env.lib_dir))
 
+@_stamped()
 def install_workflow():
     """Install Richard Bower CRUK-CI workflow manager
     Checkout the workflow manager from repository.
@@ -464,9 +2265,153 @@ def install_workflow():
         workflow_path = os.path.join(env.chipseq_installer, "workflow-manager")
         lrun('cp -r %s .' % workflow_path)
 
+# ================================================================================
+# == Build profiles of the alignment and interval tools
+
+# Flags replacing -O2 in the Makefiles of bwa, samtools and bedtools. Tools built with a
+# tuned profile run a self-check and are built again with their default flags when it fails.
+BUILD_PROFILES = {
+    "default": "",
+    "native": "-O3 -march=native",
+    "native-lto": "-O3 -march=native -flto -ffat-lto-objects",
+}
+
+# Executable of each tool in its build directory
+TUNED_TOOLS = {"bwa": "bwa", "samtools": "samtools", "bedtools": "bin/bedtools"}
+
+def _build_flags(profile=None):
+    profile = profile or env.build_profile
+    if profile not in BUILD_PROFILES:
+        abort("Unknown build profile %s, choose among %s" % (profile, ", ".join(sorted(BUILD_PROFILES))))
+    return BUILD_PROFILES[profile]
+
+def _build_profile_key():
+    """Return what the binaries built with env.build_profile depend on besides the compiler,
+    the CPU for -march=native.
+    """
+    flags = _build_flags()
+    if not flags:
+        return None
+    cpu = {}
+    if lexists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                cpu.setdefault(name.strip(), value.strip())
+    return [flags, cpu.get("model name", platform.processor()), _sha256(cpu.get("flags", ""))]
+
+def _build_tuned(tool, src_dir, build, flags=None):
+    """Run build() in src_dir, its Makefiles using flags, the flags of env.build_profile by
+    default, instead of -O2. When the tuned tool fails its self-check, build it again with
+    its default flags.
+    """
+    flags = _build_flags() if flags is None else flags
+    if flags:
+        lrun("find %s -name Makefile -exec sed -i.default -e 's/-O2\\b/%s/g' {} +" % (src_dir, flags))
+    build()
+    if flags and not _self_check(tool, os.path.join(src_dir, TUNED_TOOLS[tool])):
+        warn("%s built with %s failed its self-check, building it with its default flags" % (tool, flags))
+        lrun("find %s -name Makefile.default -exec sh -c 'mv \"$1\" \"${1%%.default}\"' sh {} \\;" % src_dir)
+        with lcd(src_dir):
+            lrun(_make("clean", parallel=False))
+        build()
+
+def _self_check(tool, binary, scale=1):
+    """Run a small workload of tool with binary and check its output.
+    """
+    work_dir = os.path.join(env.tmp_dir, "selfcheck", tool)
+    lrun("rm -rf %s" % work_dir)
+    _make_dir(work_dir)
+    command, check = TOOL_WORKLOADS[tool](binary, work_dir, scale)
+    with settings(warn_only=True):
+        with lcd(work_dir):
+            output = lrun(command, capture=True)
+    return output.succeeded and check(output)
+
+def _workload_bwa(binary, work_dir, scale):
+    """Align exact 36 bp reads taken from a random reference, at their position in their name.
+    """
+    rng = random.Random(1)
+    reference = "".join(rng.choice("ACGT") for i in range(2000 * scale))
+    with open(os.path.join(work_dir, "ref.fa"), 'w') as f:
+        f.write(">ref\n" + "".join(reference[i:i + 60] + "\n" for i in range(0, len(reference), 60)))
+    with open(os.path.join(work_dir, "reads.fq"), 'w') as f:
+        for i in range(50 * scale):
+            start = rng.randrange(len(reference) - 36)
+            f.write("@r%d_%d\n%s\n+\n%s\n" % (i, start + 1, reference[start:start + 36], "I" * 36))
+    def check(output):
+        records = [line.split("\t") for line in output.splitlines() if line and not line.startswith("@")]
+        return len(records) == 50 * scale and all(record[3] == record[0].split("_")[1] for record in records)
+    return ("{0} index ref.fa 2>/dev/null && {0} aln ref.fa reads.fq 2>/dev/null > reads.sai"
+            " && {0} samse ref.fa reads.sai reads.fq 2>/dev/null".format(binary), check)
+
+def _workload_samtools(binary, work_dir, scale):
+    """Convert unsorted SAM records to BAM, sort, index and read them back.
+    """
+    rng = random.Random(1)
+    records = ["r%d\t0\tchr1\t%d\t60\t36M\t*\t0\t0\t%s\t%s" % (i, rng.randrange(1, 10 ** 6),
+               "".join(rng.choice("ACGT") for j in range(36)), "I" * 36) for i in range(1000 * scale)]
+    with open(os.path.join(work_dir, "in.sam"), 'w') as f:
+        f.write("@HD\tVN:1.0\tSO:unsorted\n@SQ\tSN:chr1\tLN:1000036\n" + "".join(record + "\n" for record in records))
+    def check(output):
+        lines = output.splitlines()
+        positions = [int(line.split("\t")[3]) for line in lines]
+        return sorted(lines) == sorted(records) and positions == sorted(positions)
+    return ("{0} view -bS -o in.bam in.sam 2>/dev/null && {0} sort in.bam sorted && {0} index sorted.bam"
+            " && {0} view sorted.bam".format(binary), check)
+
+def _workload_bedtools(binary, work_dir, scale):
+    """Report the random intervals of a.bed overlapping those of b.bed.
+    """
+    rng = random.Random(1)
+    intervals = {}
+    for name in ("a", "b"):
+        starts = sorted(rng.randrange(10 ** 6) for i in range(500 * scale))
+        intervals[name] = [(start, start + rng.randrange(1, 2000)) for start in starts]
+        with open(os.path.join(work_dir, "%s.bed" % name), 'w') as f:
+            f.write("".join("chr1\t%d\t%d\n" % interval for interval in intervals[name]))
+    expected = ["chr1\t%d\t%d" % (a_start, a_end) for a_start, a_end in intervals["a"]
+                if any(b_start < a_end and a_start < b_end for b_start, b_end in intervals["b"])]
+    return "%s intersect -u -a a.bed -b b.bed" % binary, lambda output: output.splitlines() == expected
+
+TOOL_WORKLOADS = {"bwa": _workload_bwa, "samtools": _workload_samtools, "bedtools": _workload_bedtools}
+
+def compare_build_profiles(profile="native", scale=100):
+    """Build bwa, samtools and bedtools with their default flags and with a build profile,
+    and time both builds on the same workloads, e.g. compare_build_profiles:profile=native-lto
+    """
+    builds = {"bwa": (_bwa_url(inspect.getcallargs(_unwrap(install_bwa))["version"]), _build_bwa),
+              "samtools": (inspect.getcallargs(_unwrap(install_samtools))["url"], _build_samtools),
+              "bedtools": (inspect.getcallargs(_unwrap(install_bedtools))["url"], _build_bedtools)}
+    results = []
+    for tool in sorted(builds):
+        url, build = builds[tool]
+        times, outputs = [], []
+        for variant in ("default", profile):
+            build_dir = os.path.join(env.tmp_dir, "profiles", variant, tool)
+            lrun("rm -rf %s" % build_dir)
+            _make_dir(build_dir)
+            src_dir = os.path.join(build_dir, _fetch_and_unpack(build_dir, url))
+            _build_tuned(tool, src_dir, functools.partial(build, src_dir), _build_flags(variant))
+            work_dir = os.path.join(build_dir, "workload")
+            _make_dir(work_dir)
+            command, check = TOOL_WORKLOADS[tool](os.path.join(src_dir, TUNED_TOOLS[tool]), work_dir, int(scale))
+            start = time.time()
+            with lcd(work_dir):
+                output = lrun(command, capture=True)
+            times.append(time.time() - start)
+            if not check(output):
+                abort("%s built with the %s profile gave a wrong result" % (tool, variant))
+            outputs.append(output)
+        results.append((tool, times[0], times[1], outputs[0] == outputs[1]))
+    puts("  %-10s %10s %10s %8s %s" % ("tool", "default s", "%s s" % profile, "speedup", "same output"))
+    for tool, default_time, tuned_time, same in results:
+        puts("  %-10s %10.2f %10.2f %7.2fx %s" % (tool, default_time, tuned_time, default_time / max(tuned_time, 0.001), same))
+
 # ================================================================================
 # == Required specific tools to install chipseq pipeline
 
+@_traced("task")
 def install_tools():
     """Install chipseq specific tools:
     - UCSC tools: liftOver, TwoBitToFa, FaToTwoBit, BedToBigBed, WigToBigWig, BedGraphToBigWig
@@ -488,68 +2433,84 @@ def install_tools():
     install_sicer()
     install_gtf2bed()
 
+@_stamped(script=lambda: _sha256_file(os.path.join(env.chipseq_installer, "scripts/gtf2bed.py")))
 def install_gtf2bed():
-    """Install gtf2bed from trunk
+    """Install gtf2bed.py converting GTF files to BED
     """
-    url = "https://ea-utils.googlecode.com/svn/trunk/clipper/gtf2bed"
-    with lcd(env.bin_dir):
-    	lrun("wget %s -O gtf2bed.pl" % (url))         
+    lrun("cp %s %s" % (os.path.join(env.chipseq_installer, "scripts/gtf2bed.py"), env.bin_dir))
+    lrun("chmod a+rx %s" % os.path.join(env.bin_dir, "gtf2bed.py"))
     
-def install_openssl():
+@_stamped()
+@_artifact()
+def install_openssl(url="http://www.openssl.org/source/openssl-1.0.1e.tar.gz"):
     """Install openssl 1.0.1e
     For UCSC tools that gives libssl.so.10 error while loading shared libraries
     """
-    url = "http://www.openssl.org/source/openssl-1.0.1e.tar.gz"
     with lcd(env.tmp_dir):
         dir_name = _fetch_and_unpack(env.tmp_dir, url)
         with lcd(dir_name):
             lrun("./config --prefix=%s --shared" % env.project_dir)
-            lrun("make")
-            lrun("make install")
-    with lcd(env.lib_dir):
+            # openssl 1.0.1 makefiles are not safe for a parallel make
+            lrun(_make(parallel=False))
+            lrun(_make_install("INSTALL_PREFIX"))
+    with lcd(_staged(env.lib_dir)):
         lrun("ln -s ../lib64/libssl.so.1.0.0 libssl.so.10")
         lrun("ln -s ../lib64/libcrypto.so.1.0.0 libcrypto.so.10")
             
-def install_ucsc_tools():
+# Executables installed by install_ucsc_tools
+UCSC_TOOLS = ["liftOver", "faToTwoBit", "twoBitToFa", "bedToBigBed", "wigToBigWig", "bedGraphToBigWig"]
+
+@_stamped(tools=UCSC_TOOLS)
+def install_ucsc_tools(url="http://hgdownload.cse.ucsc.edu/admin/exe/linux.x86_64/"):
     """Install useful executables from UCSC.
     see https://github.com/chapmanb/cloudbiolinux/blob/master/cloudbio/custom/bio_nextgen.py
     for an up-to-date version
     """
-    tools = ["liftOver", "faToTwoBit", "twoBitToFa", "bedToBigBed", "wigToBigWig", "bedGraphToBigWig"]
-    url = "http://hgdownload.cse.ucsc.edu/admin/exe/linux.x86_64/"
-    for tool in tools:
+    installed = _installed("bin")
+    for tool in UCSC_TOOLS:
         with lcd(env.bin_dir):
-            if not lexists(os.path.join(env.bin_dir, tool)):
-                lrun("wget %s%s" % (url, tool))
+            if tool not in installed:
+                lrun("wget %s" % _mirror_url(url + tool))
                 lrun("chmod a+rwx %s" % tool)
 
-def install_samtools():
-    """Install samtools 0.1.18
+@_stamped(profile=_build_profile_key)
+@_artifact(profile=_build_profile_key)
+def install_samtools(url="http://sourceforge.net/projects/samtools/files/samtools/0.1.18/samtools-0.1.18.tar.bz2"):
+    """Install samtools 0.1.18, with the flags of env.build_profile
     """
-    url = "http://sourceforge.net/projects/samtools/files/samtools/0.1.18/samtools-0.1.18.tar.bz2"
     with lcd(env.tmp_dir):
         dir_name = _fetch_and_unpack(env.tmp_dir, url)
+        src_dir = os.path.join(env.tmp_dir, dir_name)
+        _build_tuned("samtools", src_dir, functools.partial(_build_samtools, src_dir))
         with lcd(dir_name):
-            lrun("make")
             # copy executables to bin
-            lrun("find . -perm /u=x -type f -exec cp {} %(bin_dir)s \;" % env)
+            lrun("find . -perm /u=x -type f -exec cp {} %s \;" % _staged(env.bin_dir))
+
+def _build_samtools(src_dir):
+    with lcd(src_dir):
+        lrun(_make())
 
-def install_bedtools():
-    """Install BEDTools 2.17.0
+@_stamped(profile=_build_profile_key)
+@_artifact(profile=_build_profile_key)
+def install_bedtools(url="http://bedtools.googlecode.com/files/BEDTools.v2.17.0.tar.gz"):
+    """Install BEDTools 2.17.0, with the flags of env.build_profile
     """
-    url = "http://bedtools.googlecode.com/files/BEDTools.v2.17.0.tar.gz"
     with lcd(env.tmp_dir):
-        # cannot _fetch_and_unpack return because package name does not match unpacked dir
-        _fetch_and_unpack(env.tmp_dir, url, False)
-        with lcd("bedtools-2.17.0"):
-            lrun("make clean")
-            lrun("make all")
-            lrun("find bin/. -perm /u=x -type f -exec cp {} %(bin_dir)s \;" % env)
+        dir_name = _fetch_and_unpack(env.tmp_dir, url)
+        src_dir = os.path.join(env.tmp_dir, dir_name)
+        _build_tuned("bedtools", src_dir, functools.partial(_build_bedtools, src_dir))
+        with lcd(dir_name):
+            lrun("find bin/. -perm /u=x -type f -exec cp {} %s \;" % _staged(env.bin_dir))
+
+def _build_bedtools(src_dir):
+    with lcd(src_dir):
+        lrun(_make("clean", parallel=False))
+        lrun(_make("all"))
 
-def install_picard():
+@_stamped()
+def install_picard(version="1.96"):
     """Install Picard 1.96
     """
-    version = "1.96"
     url = 'http://downloads.sourceforge.net/project/picard/picard-tools/%s/picard-tools-%s.zip' % (version, version)
     picard_dir = os.path.join(env.bin_dir, "picard")
     _make_dir(picard_dir)
@@ -558,30 +2519,38 @@ def install_picard():
         with lcd(dir_name):
             lrun("mv *.jar %s" % picard_dir)
 
-def install_bwa():
-    """Install BWA 0.5.9
+@_stamped(profile=_build_profile_key)
+@_artifact(profile=_build_profile_key)
+def install_bwa(version="0.5.9"):
+    """Install BWA 0.5.9, with the flags of env.build_profile
     Aligns short nucleotide sequences against a long reference sequence.
     http://bio-bwa.sourceforge.net/
     """
-    version = "0.5.9"
-    url = "http://downloads.sourceforge.net/project/bio-bwa/bwa-%s.tar.bz2" % (version)
     with lcd(env.tmp_dir):
-        dir_name = _fetch_and_unpack(env.tmp_dir, url)
+        dir_name = _fetch_and_unpack(env.tmp_dir, _bwa_url(version))
+        src_dir = os.path.join(env.tmp_dir, dir_name)
+        _build_tuned("bwa", src_dir, functools.partial(_build_bwa, src_dir))
         with lcd(dir_name):
-            arch = lrun("uname -m")
-            # if not 64bit, remove the appropriate flag
-            if arch.find("x86_64") == -1:
-                lrun("sed -i.bak -r -e 's/-O2 -m64/-O2/g' Makefile")
-            lrun("make")
             # copy executables to bin
-            lrun("find . -perm /u=x -type f -exec cp {} %(bin_dir)s \;" % env)
+            lrun("find . -perm /u=x -type f -exec cp {} %s \;" % _staged(env.bin_dir))
+
+def _bwa_url(version):
+    return "http://downloads.sourceforge.net/project/bio-bwa/bwa-%s.tar.bz2" % version
+
+def _build_bwa(src_dir):
+    with lcd(src_dir):
+        arch = lrun("uname -m", capture=True)
+        # if not 64bit, remove the appropriate flag
+        if arch.find("x86_64") == -1:
+            lrun("sed -i.bak -r -e 's/ -m64//g' Makefile")
+        lrun(_make())
 
-def install_macs():
+@_stamped()
+def install_macs(version="1.4.2"):
     """Install MACS 1.4.2
     Model-based Analysis for ChIP-Seq.
     http://liulab.dfci.harvard.edu/MACS/
     """
-    version = "1.4.2"
     url = "https://github.com/downloads/taoliu/MACS/MACS-%s.tar.gz" % version
     with lcd(env.tmp_dir):
         dir_name = _fetch_and_unpack(env.tmp_dir, url)
@@ -590,21 +2559,22 @@ def install_macs():
             lrun("chmod a+rwx bin/*")
             lrun("find bin/. -perm /u=x -type f -exec cp {} %(bin_dir)s \;" % env)
 
-def install_meme():
+@_stamped()
+@_artifact()
+def install_meme(url="http://ebi.edu.au/ftp/software/MEME/4.9.1/meme_4.9.1.tar.gz"):
     """Install meme 4.9.1
     """
-    url = "http://ebi.edu.au/ftp/software/MEME/4.9.1/meme_4.9.1.tar.gz"
     with lcd(env.tmp_dir):
         dir_name = _fetch_and_unpack(env.tmp_dir, url)
         with lcd(dir_name):
            lrun("./configure --prefix=%(meme_dir)s --with-url='http://meme.nbcr.net/meme' --with-perl=%(bin_dir)s/perl/bin/perl --with-python=%(bin_dir)s/python2.7" % env)
-           lrun("make")
-           lrun("make install")      
+           lrun(_make())
+           lrun(_make_install())
            
-def install_sicer():
+@_stamped()
+def install_sicer(url="http://home.gwu.edu/~wpeng/SICER_V1.1.tgz"):
     """Install SICER 1.1
     """
-    url = "http://home.gwu.edu/~wpeng/SICER_V1.1.tgz"
     with lcd(env.tmp_dir):
         dir_name = _fetch_and_unpack(env.tmp_dir, url)
         with lcd(dir_name):
@@ -613,20 +2583,25 @@ def install_sicer():
 # ================================================================================
 # == Install chipseq pipeline and update config file
 
+@_traced("task")
 def install_chipseq():
     install_chipseq_pipeline()
     update_config()
           
-def install_chipseq_pipeline():
+@_stamped()
+def install_chipseq_pipeline(url="https://github.com/crukci-bioinformatics/chipseq-pipeline/archive/master.zip"):
     """Get the latest chipseq code from github.
+    Run force:install_chipseq_pipeline to update it on the next deploy.
     """
     with lcd(env.project_dir):
-        lrun("wget --no-check-certificate -r https://github.com/crukci-bioinformatics/chipseq-pipeline/archive/master.zip -O master-pipeline.zip")
+        lrun("wget --no-check-certificate -r %s -O master-pipeline.zip" % _mirror_url(url))
         lrun("unzip master-pipeline.zip")
     with lcd(env.chipseq_path):
         lrun("( ( echo '#!/usr/bin/env Rscript' ; echo 'RLIBSVar = \"%s\"' ; sed '1,2d' RScripts/Kick.r ) > RScripts/ChipSeq.r )" % env.r_lib_dir)
         lrun("chmod a+x RScripts/ChipSeq.r")
         
+@_stamped(genomes=lambda: _selected_genomes(), bgzip=lambda: _as_bool(env.bgzip),
+          versions=lambda: _active_versions().get("components"))
 def update_config():
     import ConfigParser
     config = ConfigParser.SafeConfigParser()
@@ -646,7 +2621,7 @@ def update_config():
         config.set("Executables", "java", os.path.join(env.lib_dir, "%s/bin/java" % env.java_dir))
         config.set("Executables", "rexec", os.path.join(env.bin_dir, "Rscript"))
         config.set("Executables", "bigwig", os.path.join(env.bin_dir, "bedGraphToBigWig"))
-        config.set("Executables", "gtftobed", os.path.join(env.bin_dir, "gtf2bed.pl"))
+        config.set("Executables", "gtftobed", os.path.join(env.bin_dir, "gtf2bed.py"))
         config.set("Executables", "macs", os.path.join(env.bin_dir, "macs14"))
         config.set("Executables", "ame", os.path.join(env.bin_dir, "ame"))
         config.set("Executables", "sicer", os.path.join(env.bin_dir, "sicer"))
@@ -661,20 +2636,27 @@ def update_config():
         
         config.set("Libraries", "rlibs", env.r_lib_dir)
         config.set("Libraries", "pythonlibs", os.path.join(env.lib_dir, "python2.7/site-packages/"))
-        config.set("Libraries", "perllibs", os.path.join(env.bin_dir, "perl/lib/site_perl/5.18.0/"))
+        # site_perl of the active perl version
+        perl_libs = sorted(glob.glob(os.path.join(env.perl_dir, "lib/site_perl/[0-9]*"))) or \
+                    [os.path.join(env.perl_dir, "lib/site_perl/5.18.0")]
+        config.set("Libraries", "perllibs", perl_libs[-1] + "/")
         config.set("Libraries", "javalibs", "")
 
-        config.set("meme parameters", "tfdb", os.path.join(env.annotation_dir, "jaspar_CORE/Jaspar_NonRedunadant.meme"))
+        config.set("meme parameters", "tfdb", _meme_tfdb_file())
 
-        config.set("Genomes", "grch37", os.path.join(env.grch37_dir, "Homo_sapiens.GRCh37.67.dna.toplevel.fa"))
+        config.set("Genomes", "grch37", _genome_stored_file("grch37", "Homo_sapiens.GRCh37.67.dna.toplevel.fa"))
         config.set("Genomes", "hg18", "")
-        config.set("Genomes", "mm9", os.path.join(env.mm9_dir, "Mus_musculus.NCBIM37.67.dna.toplevel.fa"))
+        config.set("Genomes", "mm9", _genome_stored_file("mm9", "Mus_musculus.NCBIM37.67.dna.toplevel.fa"))
         
-        config.set("Gene Positions", "grch37", ":".join([os.path.join(env.mm9_dir, "Homo_sapiens.GRCh37.67.gtf"), os.path.join(env.mm9_dir, "hsapiens_gene_ensembl__transcript__main.txt")]))
+        config.set("Gene Positions", "grch37", ":".join([_genome_stored_file("grch37", "Homo_sapiens.GRCh37.67.gtf"), _genome_stored_file("grch37", "hsapiens_gene_ensembl__transcript__main.txt")]))
         config.set("Gene Positions", "hg18", "")
-        config.set("Gene Positions", "mm9", ":".join([os.path.join(env.mm9_dir, "Mus_musculus.NCBIM37.67.gtf"), os.path.join(env.mm9_dir, "mmusculus_gene_ensembl__transcript__main.txt")]))
+        config.set("Gene Positions", "mm9", ":".join([_genome_stored_file("mm9", "Mus_musculus.NCBIM37.67.gtf"), _genome_stored_file("mm9", "mmusculus_gene_ensembl__transcript__main.txt")]))
         
         config.set("GeneSets", "mm9", "")
+
+        for genome in _selected_genomes():
+            _config_set(config, "Gene BED", genome, _gtf_file(genome, ".bed"))
+            _config_set(config, "Gene Intervals", genome, _gtf_file(genome, ".intervals"))
         
         config.set("Excluded Regions", "grch37", "No_Excluded")
         config.set("Excluded Regions", "hg18", "No_Excluded")
@@ -684,71 +2666,267 @@ def update_config():
         config.set("ExcludedRegions", "hg18", "No_Excluded")
         config.set("ExcludedRegions", "mm9", "No_Excluded")
 
-        config.set("Chromosome Lengths", "grch37", "")
+        config.set("Chromosome Lengths", "grch37", _genome_file("grch37", ".chrom.sizes"))
         config.set("Chromosome Lengths", "hg18", "")
-        config.set("Chromosome Lengths", "mm9", "")	
+        config.set("Chromosome Lengths", "mm9", _genome_file("mm9", ".chrom.sizes"))
 
-        config.set("Sequence Dictionary", "grch37", "")
+        config.set("Sequence Dictionary", "grch37", _genome_file("grch37", ".dict"))
         config.set("Sequence Dictionary", "hg18", "")
-        config.set("Sequence Dictionary", "mm9", "")	
+        config.set("Sequence Dictionary", "mm9", _genome_file("mm9", ".dict"))
 
         config.write(inifile)
         inifile.close()
 
+def _config_set(config, section, option, value):
+    """Set option in config, adding section when the pipeline config does not have it.
+    """
+    if not config.has_section(section):
+        config.add_section(section)
+    config.set(section, option, value)
+
 # ================================================================================
 # == Install hg19 and mm9 genomes 
 
+@_traced("task")
 def install_data():
     install_genomes()
+    install_genome_indexes()
+    install_bwa_indexes()
+    install_gene_intervals()
     configure_meme()
 
+GRCH37_URLS = ["ftp://ftp.ensembl.org/pub/release-67/fasta/homo_sapiens/dna/Homo_sapiens.GRCh37.67.dna.toplevel.fa.gz", 
+    "ftp://ftp.ensembl.org/pub/release-67/gtf/homo_sapiens/Homo_sapiens.GRCh37.67.gtf.gz",
+    "ftp://ftp.ensembl.org/pub/release-67/mysql/ensembl_mart_67/hsapiens_gene_ensembl__exon_transcript__dm.txt.gz",
+    "ftp://ftp.ensembl.org/pub/release-67/mysql/ensembl_mart_67/hsapiens_gene_ensembl__transcript__main.txt.gz"]
+
+MM9_URLS = ["ftp://ftp.ensembl.org/pub/release-67/fasta/mus_musculus/dna/Mus_musculus.NCBIM37.67.dna.toplevel.fa.gz",
+    "ftp://ftp.ensembl.org/pub/release-67/gtf/mus_musculus/Mus_musculus.NCBIM37.67.gtf.gz", 
+    "ftp://ftp.ensembl.org/pub/release-67/mysql/ensembl_mart_67/mmusculus_gene_ensembl__exon_transcript__dm.txt.gz",
+    "ftp://ftp.ensembl.org/pub/release-67/mysql/ensembl_mart_67/mmusculus_gene_ensembl__transcript__main.txt.gz"]
+
+# Genomes installed by install_genomes with the directory and urls of their files
+GENOMES = {
+    "grch37": {"dir": env.grch37_dir, "urls": GRCH37_URLS,
+               "fasta": "Homo_sapiens.GRCh37.67.dna.toplevel.fa",
+               "gtf": "Homo_sapiens.GRCh37.67.gtf"},
+    "mm9": {"dir": env.mm9_dir, "urls": MM9_URLS,
+            "fasta": "Mus_musculus.NCBIM37.67.dna.toplevel.fa",
+            "gtf": "Mus_musculus.NCBIM37.67.gtf"},
+}
+
+def _selected_genomes(genomes=None):
+    """Return the sorted names of genomes, separated by ;, env.genomes by default.
+    """
+    selected = sorted(set(name.strip() for name in (genomes or env.genomes).split(";") if name.strip()))
+    unknown = [name for name in selected if name not in GENOMES]
+    if unknown:
+        abort("Unknown genomes %s, choose among %s" % (", ".join(unknown), ", ".join(sorted(GENOMES))))
+    return selected
+
+@_stamped(grch37_urls=GRCH37_URLS, mm9_urls=MM9_URLS, genomes=lambda: _selected_genomes(),
+          bgzip=lambda: _as_bool(env.bgzip))
 def install_genomes():
-	_make_dir(env.grch37_dir)
-	grch37_urls = ["ftp://ftp.ensembl.org/pub/release-67/fasta/homo_sapiens/dna/Homo_sapiens.GRCh37.67.dna.toplevel.fa.gz", 
-	    "ftp://ftp.ensembl.org/pub/release-67/gtf/homo_sapiens/Homo_sapiens.GRCh37.67.gtf.gz",
-	    "ftp://ftp.ensembl.org/pub/release-67/mysql/ensembl_mart_67/hsapiens_gene_ensembl__exon_transcript__dm.txt.gz",
-	    "ftp://ftp.ensembl.org/pub/release-67/mysql/ensembl_mart_67/hsapiens_gene_ensembl__transcript__main.txt.gz"]
-	with lcd(env.grch37_dir):
-	    for url in grch37_urls:
-	        _fetch_and_unpack_genome(env.grch37_dir, url)
-
-	_make_dir(env.mm9_dir)
-	mm9_urls = ["ftp://ftp.ensembl.org/pub/release-67/fasta/mus_musculus/dna/Mus_musculus.NCBIM37.67.dna.toplevel.fa.gz",
-	    "ftp://ftp.ensembl.org/pub/release-67/gtf/mus_musculus/Mus_musculus.NCBIM37.67.gtf.gz", 
-	    "ftp://ftp.ensembl.org/pub/release-67/mysql/ensembl_mart_67/mmusculus_gene_ensembl__exon_transcript__dm.txt.gz",
-	    "ftp://ftp.ensembl.org/pub/release-67/mysql/ensembl_mart_67/mmusculus_gene_ensembl__transcript__main.txt.gz"]
-	with lcd(env.mm9_dir):
-	    for url in mm9_urls:
-	        _fetch_and_unpack_genome(env.mm9_dir, url)
+    """Download and decompress the files of env.genomes, env.download_jobs files at a time
+    """
+    downloads = []
+    for genome in _selected_genomes():
+        _make_dir(GENOMES[genome]["dir"])
+        downloads.extend((GENOMES[genome]["dir"], url) for url in GENOMES[genome]["urls"])
+    _run_pool(_fetch_and_unpack_genome, downloads, env.download_jobs)
+
+@_stamped()
+def install_genome_indexes():
+    """Precompute the sequence index (.fai), chromosome sizes, sequence dictionary (.dict)
+    and 2bit file of each genome, one genome per fasta_index.py command
+    """
+    genomes = _selected_genomes()
+    _run_pool(_genome_sidecars, [(genome,) for genome in genomes], len(genomes))
 
+def _genome_file(genome, extension):
+    """Return the path of the genome fasta file with extension replacing .fa
+    """
+    return os.path.join(GENOMES[genome]["dir"], GENOMES[genome]["fasta"][:-len(".fa")] + extension)
+
+def _genome_stored_file(genome, name):
+    """Return the path of the genome or annotation file name of genome as stored by
+    install_genomes.
+    """
+    return os.path.join(GENOMES[genome]["dir"], _stored_name(name))
+
+def _genome_sidecars(genome):
+    fasta = _genome_stored_file(genome, GENOMES[genome]["fasta"])
+    paths = [fasta + ".fai", _genome_file(genome, ".chrom.sizes"), _genome_file(genome, ".dict"), fasta + ".sha256"]
+    # run as a command to index the genomes in parallel despite the GIL, as for gtf2bed.py
+    lrun("%s %s %s %s" % (sys.executable, inspect.getsourcefile(fasta_index), fasta,
+                          " ".join(_tmp_name(path) for path in paths)))
+    for path in paths:
+        os.rename(_tmp_name(path), path)
+    two_bit = _genome_file(genome, ".2bit")
+    lrun("%s %s %s" % (os.path.join(env.bin_dir, "faToTwoBit"), fasta, _tmp_name(two_bit)))
+    os.rename(_tmp_name(two_bit), two_bit)
+
+@_stamped()
+def install_gene_intervals():
+    """Convert the GTF of each genome to BED and write its gene and exon interval index,
+    one genome per gtf2bed.py command
+    """
+    genomes = _selected_genomes()
+    _run_pool(_genome_gene_intervals, [(genome,) for genome in genomes], len(genomes))
+
+def _gtf_file(genome, extension):
+    """Return the path of the genome GTF file with extension replacing .gtf
+    """
+    return os.path.join(GENOMES[genome]["dir"], GENOMES[genome]["gtf"][:-len(".gtf")] + extension)
+
+def _genome_gene_intervals(genome):
+    bed_file, index_file = _gtf_file(genome, ".bed"), _gtf_file(genome, ".intervals")
+    # run as a command to convert the genomes in parallel despite the GIL, as deploy_parallel runs
+    # steps in daemonic processes which cannot start a multiprocessing pool
+    lrun("%s %s %s %s %s" % (sys.executable, inspect.getsourcefile(gtf2bed), _genome_stored_file(genome, GENOMES[genome]["gtf"]),
+                             _tmp_name(bed_file), _tmp_name(index_file)))
+    os.rename(_tmp_name(bed_file), bed_file)
+    os.rename(_tmp_name(index_file), index_file)
+
+@_stamped()
+def install_bwa_indexes():
+    """Build the BWA index of each genome, one genome per worker, or reuse the index
+    built for the same fasta content in env.cache_dir/indexes
+    """
+    genomes = _selected_genomes()
+    _run_pool(_genome_bwa_index, [(genome,) for genome in genomes], len(genomes))
+
+def _genome_bwa_index(genome):
+    fasta = _genome_stored_file(genome, GENOMES[genome]["fasta"])
+    with open(fasta + ".sha256") as f:
+        fasta_sha256 = f.read().split()[0]
+    index_dir = os.path.join(env.cache_dir, "indexes", fasta_sha256, "bwa")
+    if lexists(index_dir):
+        puts("Using cached BWA index of %s" % fasta)
+    else:
+        # build in a temporary directory renamed once complete, so that installs sharing
+        # the cache never see a partial index
+        tmp_dir = _tmp_name(index_dir)
+        _make_dir(tmp_dir)
+        try:
+            prefix = os.path.join(tmp_dir, GENOMES[genome]["fasta"])
+            lrun("%s index -a bwtsw -p %s %s" % (os.path.join(env.bin_dir, "bwa"), prefix, fasta))
+            lrun("cp %s.fai %s.fai" % (fasta, prefix))
+            os.rename(tmp_dir, index_dir)
+        finally:
+            lrun("rm -rf %s" % tmp_dir)
+    # index files are named after the fasta file, also when it is stored in BGZF
+    for name in os.listdir(index_dir):
+        _link_or_copy(os.path.join(index_dir, name),
+                      os.path.join(GENOMES[genome]["dir"], name.replace(GENOMES[genome]["fasta"], os.path.basename(fasta), 1)))
+
+JASPAR_URL = "http://jaspar.genereg.net/html/DOWNLOAD/ARCHIVE/JASPAR2010/JASPAR_CORE/non_redundant/all_species/FlatFileDir/"
+
+@_stamped(script=lambda: _sha256_file(os.path.join(env.chipseq_installer, "scripts/jaspar2meme.py")))
 def configure_meme():
-    with lcd(env.annotation_dir):
-	    URLForJasparAll =  "http://jaspar.genereg.net/html/DOWNLOAD/ARCHIVE/JASPAR2010/JASPAR_CORE/non_redundant/all_species/FlatFileDir/"
-	    lrun('wget -r -nH --cut-dirs=2 --no-parent --reject=\"index.html*\" %s ' % (URLForJasparAll))
-	    JasparLocation = os.path.join(env.annotation_dir, "ARCHIVE/JASPAR2010/JASPAR_CORE/non_redundant/all_species/FlatFileDir/") 
-	    MemeJasparLocation = os.path.join(env.annotation_dir, "ARCHIVE/JASPAR2010/JASPAR_CORE/Jaspar_NonRedunadant.meme") 
-	    ConvertCMD = os.path.join(env.bin_dir, "meme/bin/jaspar2meme  -pfm")
-	    lrun("%s %s > %s" % (ConvertCMD,JasparLocation,MemeJasparLocation))
-	    
+    """Write the MEME motif database of the JASPAR core matrices, from the matrices parsed
+    and kept in env.cache_dir/motifs by an earlier install when there is one
+    """
+    # keyed by the converter too, a fix to jaspar2meme.py parses the matrices again
+    script = _sha256_file(os.path.join(env.chipseq_installer, "scripts/jaspar2meme.py"))
+    motifs_file = os.path.join(env.cache_dir, "motifs", "%s.motifs" % _sha256("%s %s" % (JASPAR_URL, script)))
+    if lexists(motifs_file):
+        puts("Using cached JASPAR matrices %s" % motifs_file)
+        motifs = jaspar2meme.Motifs.load(motifs_file)
+    else:
+        motifs = _fetch_jaspar(JASPAR_URL)
+        _make_dir(os.path.dirname(motifs_file))
+        motifs.write(_tmp_name(motifs_file))
+        os.rename(_tmp_name(motifs_file), motifs_file)
+    tfdb_file = _meme_tfdb_file()
+    _make_dir(os.path.dirname(tfdb_file))
+    with open(_tmp_name(tfdb_file), 'w') as out:
+        motifs.write_meme(out)
+    os.rename(_tmp_name(tfdb_file), tfdb_file)
+
+def _meme_tfdb_file():
+    return os.path.join(env.annotation_dir, "jaspar_CORE/Jaspar_NonRedunadant.meme")
+
+def _fetch_jaspar(url):
+    """Fetch the .pfm files and matrix_list.txt listed in the JASPAR directory page url and
+    parse them.
+    """
+    listing = _fetch_small_files([url])[0].decode("latin-1")
+    names = sorted(set(name for name in re.findall(r'href="([^"/?]+)"', listing)
+                       if name.endswith(".pfm") or name == "matrix_list.txt"))
+    if not [name for name in names if name.endswith(".pfm")]:
+        abort("No JASPAR matrices found in %s" % url)
+    puts("Downloading %d JASPAR files from %s" % (len(names), url))
+    contents = dict(zip(names, [content.decode("latin-1") for content in _fetch_small_files([url + name for name in names])]))
+    matrix_list = contents.pop("matrix_list.txt", "")
+    return jaspar2meme.Motifs.parse([(name[:-len(".pfm")], text) for name, text in contents.items()],
+                                    jaspar2meme.read_matrix_list(matrix_list))
+
+# ================================================================================
+# == Prefetch the inputs of a run
+
+def prefetch(samplesheet=None, genomes=None, jobs=None):
+    """Download into the cache only the FASTQ files of a sample sheet and the files of
+    genomes, separated by ;, e.g. prefetch:samplesheet=SampleSheet.csv,genomes=mm9
+    """
+    urls = _samplesheet_urls(samplesheet or _samplesheet_file())
+    for genome in _selected_genomes(genomes):
+        urls.extend(GENOMES[genome]["urls"])
+    for name in ("tmp", "objects", "urls"):
+        _make_dir(_cache_path(name))
+    missing = [url for url in urls if not _cache_lookup(url, verify=False)]
+    puts("Prefetching %d files, %d already in the download cache" % (len(missing), len(urls) - len(missing)))
+    if not missing:
+        return
+    progress = {"done": 0, "total": len(missing), "bytes": 0, "start": time.time(), "lock": threading.Lock()}
+    _run_pool(_prefetch_url, [(url, progress) for url in missing], jobs or env.download_jobs)
+    elapsed = time.time() - progress["start"]
+    puts("Prefetched %.1f MB in %.0f s, %.1f MB/s" % (progress["bytes"] / 1024.0 ** 2, elapsed,
+                                                    progress["bytes"] / 1024.0 ** 2 / max(elapsed, 0.001)))
+
+def _prefetch_url(url, progress):
+    start = time.time()
+    size = os.path.getsize(_fetch_cached(url))
+    elapsed = max(time.time() - start, 0.001)
+    with progress["lock"]:
+        progress["done"] += 1
+        progress["bytes"] += size
+        puts("[%d/%d] %s, %.1f MB in %.0f s, %.1f MB/s" % (progress["done"], progress["total"], url,
+                                                         size / 1024.0 ** 2, elapsed, size / 1024.0 ** 2 / elapsed))
+
+def _samplesheet_file():
+    """Return the sample sheet of the test run, moved to the project by install_test.
+    """
+    for test_dir in (env.test_dir, os.path.join(env.chipseq_installer, "chipseq-test")):
+        if lexists(os.path.join(test_dir, "SampleSheet.csv")):
+            return os.path.join(test_dir, "SampleSheet.csv")
+    abort("No SampleSheet.csv found in %s" % env.test_dir)
+
+def _samplesheet_urls(samplesheet):
+    """Return the urls in the FQLocation column of samplesheet, once each, in order.
+    """
+    urls = []
+    with open(samplesheet) as f:
+        for row in csv.DictReader(f):
+            location = (row.get("FQLocation") or "").strip()
+            if "://" in location and location not in urls:
+                urls.append(location)
+    return urls
 
 # ================================================================================
 # == Install Ikaros ChIP test data
 
+@_stamped()
 def install_test():
     with lcd(env.project_dir):
         lrun('mv %s .' % os.path.join(env.chipseq_installer, 'chipseq-test'))
 
+@_stamped(samplesheet=lambda: _samplesheet_urls(_samplesheet_file()))
 def fetch_testdata():
-	_make_dir(env.testfq_dir)
-	fq_urls = ["ftp://ftp.sra.ebi.ac.uk/vol1/fastq/SRR619/SRR619469/SRR619469.fastq.gz",
-	    "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/SRR619/SRR619470/SRR619470.fastq.gz",
-	    "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/SRR619/SRR619471/SRR619471.fastq.gz",
-	    "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/SRR619/SRR619472/SRR619472.fastq.gz",
-	    "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/SRR619/SRR619473/SRR619473.fastq.gz",
-	    "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/SRR619/SRR619474/SRR619474.fastq.gz"]
-	with cd(env.testfq_dir):
-	    for fq_url in fq_urls:
-	        _fetch(env.testfq_dir, fq_url)
+    """Download the FASTQ files of the test sample sheet, env.download_jobs files at a time
+    """
+    _make_dir(env.testfq_dir)
+    _run_pool(_fetch, [(env.testfq_dir, url) for url in _samplesheet_urls(_samplesheet_file())], env.download_jobs)
 
 
 
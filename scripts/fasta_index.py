@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Write the samtools index (.fai), chromosome sizes, Picard sequence dictionary (.dict) and
+sha256 of a genome FASTA file, reading it only once.
+
+Usage:
+    fasta_index.py genome.fa genome.fa.fai genome.chrom.sizes genome.dict genome.fa.sha256
+The FASTA may be gzipped, or block gzipped by install_genomes, when its name ends with .gz.
+The .fai offsets are those of the decompressed FASTA, as samtools faidx expects with a .gzi.
+"""
+import os
+import sys
+import gzip
+import hashlib
+
+
+def open_fasta(fasta_file):
+    """Open fasta_file for reading bytes, decompressing it when its name ends with .gz.
+    """
+    if fasta_file.endswith(".gz"):
+        return gzip.open(fasta_file, 'rb')
+    return open(fasta_file, 'rb')
+
+
+def read_sequences(fasta, digest):
+    """Return [name, length, offset, bases per line, bytes per line, md5] of each sequence of
+    the FASTA file object fasta, updating digest with its content.
+    """
+    sequences = []
+    sequence = None
+    offset = 0
+    for line in fasta:
+        offset += len(line)
+        digest.update(line)
+        if line.startswith(b">"):
+            name = line[1:].split()[0].decode("ascii")
+            sequence = [name, 0, offset, 0, 0, hashlib.md5()]
+            sequences.append(sequence)
+            continue
+        bases = line.rstrip(b"\r\n")
+        if sequence[3] == 0:
+            sequence[3], sequence[4] = len(bases), len(line)
+        sequence[1] += len(bases)
+        sequence[5].update(bases.upper())
+    return sequences
+
+
+def index(fasta_file, fai_file, sizes_file, dict_file, sha256_file):
+    digest = hashlib.sha256()
+    with open_fasta(fasta_file) as fasta:
+        sequences = read_sequences(fasta, digest)
+    with open(fai_file, 'w') as fai, open(sizes_file, 'w') as sizes, open(dict_file, 'w') as seq_dict:
+        seq_dict.write("@HD\tVN:1.0\tSO:unsorted\n")
+        for name, length, offset, line_bases, line_bytes, md5 in sequences:
+            fai.write("%s\t%d\t%d\t%d\t%d\n" % (name, length, offset, line_bases, line_bytes))
+            sizes.write("%s\t%d\n" % (name, length))
+            seq_dict.write("@SQ\tSN:%s\tLN:%d\tM5:%s\tUR:file:%s\n" % (name, length, md5.hexdigest(), fasta_file))
+    with open(sha256_file, 'w') as f:
+        f.write("%s  %s\n" % (digest.hexdigest(), os.path.basename(fasta_file)))
+
+
+def main(argv):
+    if len(argv) != 6:
+        sys.stderr.write(__doc__)
+        return 1
+    index(*argv[1:])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
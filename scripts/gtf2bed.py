@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Convert an Ensembl GTF file to BED12, one line per transcript, and build a gene and exon
+interval index of the GTF that can be searched without reading the GTF again.
+
+The GTF is read as a stream: transcripts are kept only until the next gene starts, their
+exons in arrays of integers rather than one dictionary per GTF line, so that a 600 MB
+GTF is converted in a small amount of memory.
+
+Usage:
+    gtf2bed.py Homo_sapiens.GRCh37.67.gtf > Homo_sapiens.GRCh37.67.bed
+    gtf2bed.py Homo_sapiens.GRCh37.67.gtf Homo_sapiens.GRCh37.67.bed Homo_sapiens.GRCh37.67.intervals
+The GTF may be gzipped, or block gzipped by install_genomes, when its name ends with .gz.
+"""
+import sys
+import gzip
+import json
+import bisect
+from array import array
+
+INDEX_MAGIC = b"chipseq-interval-index 1\n"
+
+# array type for coordinates and record numbers, 4 bytes on all supported platforms
+COORDINATE = 'I'
+
+
+def _attribute(attributes, name):
+    """Return the value of attribute name in a GTF attributes column.
+    """
+    start = attributes.find(name + ' "')
+    if start == -1:
+        return None
+    start += len(name) + 2
+    return attributes[start:attributes.index('"', start)]
+
+
+def read_transcripts(gtf):
+    """Yield (chrom, strand, gene_id, transcript_id, exon starts, exon ends, cds start, cds end)
+    for each transcript of the GTF file object gtf, with 0-based half-open coordinates and
+    exons sorted by start. cds start and end are None for non coding transcripts.
+    """
+    pending = {}
+    order = []
+    current_gene = None
+    for line in gtf:
+        if line.startswith("#"):
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) < 9:
+            continue
+        chrom, feature, start, end, strand, attributes = fields[0], fields[2], fields[3], fields[4], fields[6], fields[8]
+        if feature not in ("exon", "CDS", "start_codon", "stop_codon"):
+            continue
+        gene_id = _attribute(attributes, "gene_id")
+        transcript_id = _attribute(attributes, "transcript_id")
+        if gene_id != current_gene:
+            # Ensembl GTF files list all the lines of a gene together
+            for transcript in _flush(pending, order):
+                yield transcript
+            current_gene = gene_id
+        transcript = pending.get(transcript_id)
+        if transcript is None:
+            transcript = [chrom, strand, gene_id, transcript_id, array(COORDINATE), array(COORDINATE), None, None]
+            pending[transcript_id] = transcript
+            order.append(transcript_id)
+        start, end = int(start) - 1, int(end)
+        if feature == "exon":
+            transcript[4].append(start)
+            transcript[5].append(end)
+        else:
+            if transcript[6] is None or start < transcript[6]:
+                transcript[6] = start
+            if transcript[7] is None or end > transcript[7]:
+                transcript[7] = end
+    for transcript in _flush(pending, order):
+        yield transcript
+
+
+def _flush(pending, order):
+    for transcript_id in order:
+        transcript = pending[transcript_id]
+        if transcript[4]:
+            exons = sorted(zip(transcript[4], transcript[5]))
+            transcript[4] = array(COORDINATE, [start for start, end in exons])
+            transcript[5] = array(COORDINATE, [end for start, end in exons])
+            yield tuple(transcript)
+    pending.clear()
+    del order[:]
+
+
+def bed_line(transcript):
+    """Return the BED12 line of a transcript as yielded by read_transcripts.
+    """
+    chrom, strand, gene_id, transcript_id, starts, ends, cds_start, cds_end = transcript
+    tx_start, tx_end = starts[0], max(ends)
+    if cds_start is None:
+        cds_start = cds_end = tx_start
+    return "%s\t%d\t%d\t%s\t0\t%s\t%d\t%d\t0\t%d\t%s,\t%s,\n" % (
+        chrom, tx_start, tx_end, transcript_id, strand, cds_start, cds_end, len(starts),
+        ",".join(str(end - start) for start, end in zip(starts, ends)),
+        ",".join(str(start - tx_start) for start in starts))
+
+
+class IntervalIndex(object):
+    """Gene and exon intervals of a genome sorted by chromosome and start, held in arrays.
+
+    The index file starts with INDEX_MAGIC and a JSON header line giving the gene ids and,
+    for each chromosome, the position and number of its genes and exons and their longest
+    interval. It is followed by the arrays gene starts, gene ends, exon starts, exon ends
+    and exon gene numbers.
+    """
+    def __init__(self, header, arrays):
+        self.header = header
+        self.gene_ids = header["gene_ids"]
+        self.chroms = dict((chrom[0], chrom[1:]) for chrom in header["chroms"])
+        self.gene_starts, self.gene_ends, self.exon_starts, self.exon_ends, self.exon_genes = arrays
+
+    @classmethod
+    def build(cls, transcripts):
+        """Build the index from transcripts as yielded by read_transcripts.
+        """
+        genes = {} # gene id: [chrom, start, end, number in order of appearance]
+        exon_starts, exon_ends, exon_genes = array(COORDINATE), array(COORDINATE), array(COORDINATE)
+        gene_exons = set() # exons of the current gene, to store exons shared by transcripts once
+        for chrom, strand, gene_id, transcript_id, starts, ends, cds_start, cds_end in transcripts:
+            gene = genes.get(gene_id)
+            if gene is None:
+                gene = genes[gene_id] = [chrom, starts[0], max(ends), len(genes)]
+                gene_exons.clear()
+            else:
+                gene[1], gene[2] = min(gene[1], starts[0]), max(gene[2], max(ends))
+            for exon in zip(starts, ends):
+                if exon not in gene_exons:
+                    gene_exons.add(exon)
+                    exon_starts.append(exon[0])
+                    exon_ends.append(exon[1])
+                    exon_genes.append(gene[3])
+        gene_order = sorted(genes, key=lambda gene_id: (genes[gene_id][0], genes[gene_id][1], gene_id))
+        # renumber genes in index order
+        numbers = array(COORDINATE, [0] * len(genes))
+        for number, gene_id in enumerate(gene_order):
+            numbers[genes[gene_id][3]] = number
+        chrom_of = [genes[gene_id][0] for gene_id in gene_order]
+        exon_order = sorted(range(len(exon_starts)), key=lambda i: (chrom_of[numbers[exon_genes[i]]], exon_starts[i], exon_ends[i]))
+        arrays = (array(COORDINATE, [genes[gene_id][1] for gene_id in gene_order]),
+                  array(COORDINATE, [genes[gene_id][2] for gene_id in gene_order]),
+                  array(COORDINATE, [exon_starts[i] for i in exon_order]),
+                  array(COORDINATE, [exon_ends[i] for i in exon_order]),
+                  array(COORDINATE, [numbers[exon_genes[i]] for i in exon_order]))
+        exon_chroms = [chrom_of[gene] for gene in arrays[4]]
+        chroms = []
+        gene_index = exon_index = 0
+        for chrom in sorted(set(genes[gene_id][0] for gene_id in gene_order)):
+            gene_first, exon_first = gene_index, exon_index
+            while gene_index < len(gene_order) and genes[gene_order[gene_index]][0] == chrom:
+                gene_index += 1
+            while exon_index < len(exon_chroms) and exon_chroms[exon_index] == chrom:
+                exon_index += 1
+            chroms.append([chrom, gene_first, gene_index - gene_first, exon_first, exon_index - exon_first,
+                           max([arrays[1][i] - arrays[0][i] for i in range(gene_first, gene_index)] or [0]),
+                           max([arrays[3][i] - arrays[2][i] for i in range(exon_first, exon_index)] or [0])])
+        header = {"gene_ids": gene_order, "chroms": chroms, "byteorder": sys.byteorder}
+        return cls(header, arrays)
+
+    def write(self, path):
+        with open(path, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(json.dumps(self.header).encode("ascii") + b"\n")
+            for values in (self.gene_starts, self.gene_ends, self.exon_starts, self.exon_ends, self.exon_genes):
+                values.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            if f.readline() != INDEX_MAGIC:
+                raise ValueError("%s is not an interval index" % path)
+            header = json.loads(f.readline().decode("ascii"))
+            genes = len(header["gene_ids"])
+            exons = sum(chrom[4] for chrom in header["chroms"])
+            arrays = []
+            for count in (genes, genes, exons, exons, exons):
+                values = array(COORDINATE)
+                values.fromfile(f, count)
+                if header["byteorder"] != sys.byteorder:
+                    values.byteswap()
+                arrays.append(values)
+        return cls(header, arrays)
+
+    def genes(self, chrom, start, end):
+        """Return the ids of the genes overlapping chrom:start-end, 0-based half-open.
+        """
+        if chrom not in self.chroms:
+            return []
+        first, count, exon_first, exon_count, longest_gene, longest_exon = self.chroms[chrom]
+        return [self.gene_ids[i] for i in self._overlaps(self.gene_starts, self.gene_ends,
+                                                          first, count, longest_gene, start, end)]
+
+    def exons(self, chrom, start, end):
+        """Return (start, end, gene id) of the exons overlapping chrom:start-end, 0-based half-open.
+        """
+        if chrom not in self.chroms:
+            return []
+        first, count, exon_first, exon_count, longest_gene, longest_exon = self.chroms[chrom]
+        return [(self.exon_starts[i], self.exon_ends[i], self.gene_ids[self.exon_genes[i]])
+                for i in self._overlaps(self.exon_starts, self.exon_ends,
+                                        exon_first, exon_count, longest_exon, start, end)]
+
+    @staticmethod
+    def _overlaps(starts, ends, first, count, longest, start, end):
+        # intervals overlapping start-end start between start - longest and end
+        low = bisect.bisect_left(starts, max(0, start - longest), first, first + count)
+        high = bisect.bisect_left(starts, end, low, first + count)
+        return [i for i in range(low, high) if ends[i] > start]
+
+
+def open_gtf(gtf_file):
+    """Open gtf_file for reading lines, decompressing it when its name ends with .gz.
+    """
+    if gtf_file.endswith(".gz"):
+        return gzip.open(gtf_file, 'rt')
+    return open(gtf_file)
+
+
+def convert(gtf_file, bed_file, index_file=None):
+    """Write the BED12 file of gtf_file and, when index_file is given, its interval index,
+    reading the GTF only once.
+    """
+    with open_gtf(gtf_file) as gtf:
+        with open(bed_file, 'w') as bed:
+            def transcripts():
+                for transcript in read_transcripts(gtf):
+                    bed.write(bed_line(transcript))
+                    yield transcript
+            if index_file:
+                IntervalIndex.build(transcripts()).write(index_file)
+            else:
+                for transcript in transcripts():
+                    pass
+
+
+def main(argv):
+    if len(argv) == 2:
+        with open_gtf(argv[1]) as gtf:
+            for transcript in read_transcripts(gtf):
+                sys.stdout.write(bed_line(transcript))
+    elif len(argv) in (3, 4):
+        convert(*argv[1:])
+    else:
+        sys.stderr.write(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Convert JASPAR position frequency matrices (.pfm files) to a MEME motif database, as MEME's
+jaspar2meme -pfm does, without needing MEME installed.
+
+The matrices are parsed in a single array of counts, which can be written to a binary motif
+file and loaded again without parsing the matrices.
+
+Usage:
+    jaspar2meme.py FlatFileDir > Jaspar_NonRedunadant.meme
+    jaspar2meme.py FlatFileDir Jaspar_NonRedunadant.meme Jaspar_NonRedunadant.motifs
+"""
+import os
+import re
+import sys
+import json
+from array import array
+
+MOTIFS_MAGIC = b"chipseq-motifs 1\n"
+
+ALPHABET = "ACGT"
+
+JASPAR_URL = "http://jaspar.genereg.net/cgi-bin/jaspar_db.pl?ID=%s&rm=present&collection=CORE"
+
+# counts in the plain JASPAR format "0 3 79 40" or in the newer "A [ 0 3 79 40 ]"
+NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+
+def read_matrix_list(text):
+    """Return {matrix id: name} of the JASPAR matrix_list.txt text.
+    """
+    names = {}
+    for line in text.splitlines():
+        fields = line.split("\t")
+        if len(fields) >= 3:
+            names[fields[0]] = fields[2]
+    return names
+
+
+class Motifs(object):
+    """Count matrices of motifs, held in one array of counts, motif after motif, each as
+    its A, C, G and T rows.
+
+    The binary motif file starts with MOTIFS_MAGIC and a JSON header line giving the ids,
+    names and widths of the motifs, and is followed by the array of counts.
+    """
+    def __init__(self, header, counts):
+        self.header = header
+        self.ids, self.names, self.widths = header["ids"], header["names"], header["widths"]
+        self.counts = counts
+
+    @classmethod
+    def parse(cls, pfms, names=None):
+        """Parse pfms, a list of (matrix id, .pfm text), names giving the name of each id.
+        """
+        names = names or {}
+        counts = array('d')
+        ids, widths = [], []
+        for matrix_id, text in sorted(pfms):
+            # newer files start with a >id name line
+            values = [float(value) for line in text.splitlines() if not line.startswith(">")
+                      for value in NUMBER.findall(line)]
+            if not values or len(values) % len(ALPHABET):
+                raise ValueError("%s is not a %d row matrix" % (matrix_id, len(ALPHABET)))
+            counts.extend(values)
+            ids.append(matrix_id)
+            widths.append(len(values) // len(ALPHABET))
+        header = {"ids": ids, "names": [names.get(matrix_id, "") for matrix_id in ids],
+                  "widths": widths, "byteorder": sys.byteorder}
+        return cls(header, counts)
+
+    @classmethod
+    def read_dir(cls, pfm_dir):
+        """Parse the .pfm files of pfm_dir and the names of its matrix_list.txt.
+        """
+        pfms = []
+        for name in os.listdir(pfm_dir):
+            if name.endswith(".pfm"):
+                with open(os.path.join(pfm_dir, name)) as f:
+                    pfms.append((name[:-len(".pfm")], f.read()))
+        names = {}
+        if os.path.exists(os.path.join(pfm_dir, "matrix_list.txt")):
+            with open(os.path.join(pfm_dir, "matrix_list.txt")) as f:
+                names = read_matrix_list(f.read())
+        return cls.parse(pfms, names)
+
+    def write(self, path):
+        with open(path, 'wb') as f:
+            f.write(MOTIFS_MAGIC)
+            f.write(json.dumps(self.header).encode("ascii") + b"\n")
+            self.counts.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            if f.readline() != MOTIFS_MAGIC:
+                raise ValueError("%s is not a motif file" % path)
+            header = json.loads(f.readline().decode("ascii"))
+            counts = array('d')
+            counts.fromfile(f, sum(header["widths"]) * len(ALPHABET))
+            if header["byteorder"] != sys.byteorder:
+                counts.byteswap()
+        return cls(header, counts)
+
+    def write_meme(self, out):
+        """Write the motifs in MEME format to the file object out, with letter probabilities
+        at each position and a uniform background.
+        """
+        out.write("MEME version 4\n\nALPHABET= %s\n\nstrands: + -\n\n" % ALPHABET)
+        out.write("Background letter frequencies\n%s\n\n" % " ".join("%s %g" % (letter, 1.0 / len(ALPHABET))
+                                                                     for letter in ALPHABET))
+        offset = 0
+        for matrix_id, name, width in zip(self.ids, self.names, self.widths):
+            rows = [self.counts[offset + row * width:offset + (row + 1) * width] for row in range(len(ALPHABET))]
+            offset += width * len(ALPHABET)
+            totals = [sum(column) for column in zip(*rows)]
+            out.write("MOTIF %s %s\n\n" % (matrix_id, name) if name else "MOTIF %s\n\n" % matrix_id)
+            out.write("letter-probability matrix: alength= %d w= %d nsites= %d E= 0\n"
+                      % (len(ALPHABET), width, int(round(max(totals or [0])))))
+            for position, total in enumerate(totals):
+                out.write("".join(" %9.6f\t" % (rows[row][position] / total if total else 1.0 / len(ALPHABET))
+                                  for row in range(len(ALPHABET))) + "\n")
+            out.write("\nURL %s\n\n" % (JASPAR_URL % matrix_id))
+
+
+def main(argv):
+    if len(argv) == 2:
+        Motifs.read_dir(argv[1]).write_meme(sys.stdout)
+    elif len(argv) in (3, 4):
+        motifs = Motifs.read_dir(argv[1])
+        with open(argv[2], 'w') as out:
+            motifs.write_meme(out)
+        if len(argv) == 4:
+            motifs.write(argv[3])
+    else:
+        sys.stderr.write(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))